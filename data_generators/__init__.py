@@ -1,4 +1,2 @@
 from . import wmt
 from . import base
-from . import utils
-from . import preprocess
@@ -14,12 +14,13 @@ from tensor2tensor.data_generators import text_encoder
 from tensor2tensor.data_generators import generator_utils
 
 from tensor2tensor.data_generators.translate import TranslateProblem
-from tensor2tensor.data_generators.translate import compile_data
 from tensor2tensor.data_generators.translate import bi_vocabs_token_generator
 
 import random
 import io
 
+from . import utils
+
 # End-of-sentence marker.
 EOS = text_encoder.EOS_ID
 
@@ -156,18 +157,17 @@ class TranslateEnzhWmtBase(TranslateProblem):
     def generator(self, data_dir, tmp_dir, train):
         datasets = self.get_datasets(train)
 
-        # build vocab from training datasets
-        source_datasets = [[item[0], [item[1][0]]] for item in self.get_datasets(train=True)]
-        target_datasets = [[item[0], [item[1][1]]] for item in self.get_datasets(train=True)]
-        source_vocab = generator_utils.get_or_generate_vocab(
-            data_dir, tmp_dir, self.source_vocab_name, self.targeted_vocab_size,
-            source_datasets)
-        target_vocab = generator_utils.get_or_generate_vocab(
-            data_dir, tmp_dir, self.target_vocab_name, self.targeted_vocab_size,
-            target_datasets)
+        # build vocab from training datasets, see utils.sample_datasets
+        train_datasets = self.get_datasets(train=True)
+        source_vocab = generator_utils.get_or_generate_vocab_inner(
+            data_dir, self.source_vocab_name, self.targeted_vocab_size,
+            utils.sample_datasets(tmp_dir, train_datasets, 0))
+        target_vocab = generator_utils.get_or_generate_vocab_inner(
+            data_dir, self.target_vocab_name, self.targeted_vocab_size,
+            utils.sample_datasets(tmp_dir, train_datasets, 1))
 
         tag = "train" if train else "dev"
-        data_path = compile_data(tmp_dir, datasets, "wmt_zhen_tok_%s" % tag)
+        data_path = utils.compile_data_cached(tmp_dir, datasets, "wmt_zhen_tok_%s" % tag)
         return bi_vocabs_token_generator(data_path + ".lang1", data_path + ".lang2",
                                             source_vocab, target_vocab, EOS)
 
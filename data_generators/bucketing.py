@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Length-bucketed training shards.
+
+generator_utils.generate_files deals examples round-robin to shards, which
+are then shuffled, so every shard mixes short and long sentences. Here the
+pairs of an EncodedCorpus are ordered by (source bucket, target bucket) and
+then by length, and split into contiguous shards: each shard holds one or a
+few neighbouring buckets, sorted by length, so batches read from a single
+shard need little padding.
+
+The length histogram of the corpus is written as json next to the shards:
+
+    {"boundaries": [...],
+     "buckets": [[source bucket, target bucket, count], ...],
+     "shards": [{"filename": ..., "count": ..., "inputs": [min, max], "targets": [min, max]}, ...]}
+"""
+import tensorflow as tf
+import os
+import json
+
+import numpy as np
+
+from tensor2tensor.data_generators import generator_utils
+
+from . import encoded
+
+# default bucket boundaries, in subword tokens including eos
+BUCKET_BOUNDARIES = [8, 16, 24, 32, 48, 64, 96, 128, 192, 256]
+
+def bucket_ids(lengths, boundaries):
+    """Bucket of each length: i such that boundaries[i-1] <= length < boundaries[i]"""
+    return np.searchsorted(np.asarray(boundaries), lengths, side="right")
+
+def bucket_order(source_lengths, target_lengths, boundaries):
+    """Indices of pairs sorted by (source bucket, target bucket, source length, target length)"""
+    source_buckets = bucket_ids(source_lengths, boundaries)
+    target_buckets = bucket_ids(target_lengths, boundaries)
+    # lexsort sorts by the last key first
+    return np.lexsort((target_lengths, source_lengths, target_buckets, source_buckets))
+
+def length_histogram(source_lengths, target_lengths, boundaries):
+    """Non-empty (source bucket, target bucket, count) triples"""
+    num_buckets = len(boundaries) + 1
+    counts = np.zeros((num_buckets, num_buckets), dtype=np.int64)
+    np.add.at(counts, (bucket_ids(source_lengths, boundaries),
+                       bucket_ids(target_lengths, boundaries)), 1)
+    return [[int(s), int(t), int(counts[s, t])] for s, t in zip(*np.nonzero(counts))]
+
+def generate_bucketed_files(corpus, filepaths, eos=None, boundaries=BUCKET_BOUNDARIES,
+                            histogram_path=None):
+    """Write the pairs of corpus to filepaths, as length-sorted shards
+    grouped by length bucket. Shards have about the same number of pairs.
+
+    Args:
+        corpus: EncodedCorpus
+        filepaths: shard file paths, in bucket order
+        eos: id appended to both sides if not None, counted in the lengths
+        histogram_path: where to write the length histogram json, if not None
+    """
+    source_lengths, target_lengths = corpus.lengths()
+    extra = 0 if eos is None else 1
+    source_lengths = source_lengths.astype(np.int64) + extra
+    target_lengths = target_lengths.astype(np.int64) + extra
+
+    order = bucket_order(source_lengths, target_lengths, boundaries)
+    shards = []
+    for filepath, indices in zip(filepaths, np.array_split(order, len(filepaths))):
+        generator_utils.generate_files(
+            encoded.encoded_token_generator(corpus, eos, indices=indices), [filepath])
+        shard = {"filename": os.path.basename(filepath), "count": len(indices)}
+        if len(indices):
+            for side, lengths in [("inputs", source_lengths), ("targets", target_lengths)]:
+                shard[side] = [int(lengths[indices].min()), int(lengths[indices].max())]
+        shards.append(shard)
+
+    histogram = {
+        "boundaries": list(boundaries),
+        "buckets": length_histogram(source_lengths, target_lengths, boundaries),
+        "shards": shards,
+    }
+    tf.logging.info("[bucketing] wrote %d pairs to %d shards, %d non-empty buckets" %
+                    (len(order), len(filepaths), len(histogram["buckets"])))
+    if histogram_path is not None:
+        with tf.gfile.GFile(histogram_path, mode="w") as f:
+            json.dump(histogram, f, indent=1)
+    return histogram
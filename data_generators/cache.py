@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed cache for datagen stages.
+
+Each preprocessed dataset file is stored as its own artifact, keyed on
+(dataset url, file in archive, use_jieba, preprocessing version).
+A manifest is written only after the artifact is complete, so an
+interrupted run redoes only the missing artifacts.
+"""
+import tensorflow as tf
+import os
+import json
+import hashlib
+
+from tensor2tensor.data_generators.generator_utils import maybe_download
+
+from . import utils
+from . import provenance
+from . import compressed
+
+# bytes per read when concatenating files
+_COPY_BLOCK_SIZE = 2**20
+
+def stage_key(url, lang_file, use_jieba):
+    """Cache key of a preprocessed dataset file"""
+    key = json.dumps([url, lang_file, bool(use_jieba), utils.PREPROCESS_VERSION])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def _artifact_path(cache_dir, key, lang):
+    return os.path.join(cache_dir, "%s.%s" % (key, lang))
+
+def _manifest_path(cache_dir, key):
+    return os.path.join(cache_dir, "%s.json" % key)
+
+def is_cached(cache_dir, key, lang):
+    """True if artifact has a completion manifest matching its size"""
+    artifact = _artifact_path(cache_dir, key, lang)
+    manifest = _manifest_path(cache_dir, key)
+    if not utils.do_files_exist([artifact, manifest]):
+        return False
+    with tf.gfile.GFile(manifest, mode="r") as f:
+        info = json.load(f)
+    return info["bytes"] == tf.gfile.Stat(artifact).length
+
+def _write_manifest(cache_dir, key, info):
+    manifest = _manifest_path(cache_dir, key)
+    with tf.gfile.GFile(manifest + ".incomplete", mode="w") as f:
+        json.dump(info, f)
+    tf.gfile.Rename(manifest + ".incomplete", manifest, overwrite=True)
+
+def prepare_data_cached(tmp_dir, sources, cache_dir, use_jieba=True, num_workers=1):
+    """Preprocess dataset files into cache_dir, skipping cached artifacts.
+    Archives are downloaded and read only if some of their files are missing.
+
+    Returns:
+        dict of lang -> list of artifact paths, in order of sources.
+    """
+    tf.gfile.MakeDirs(cache_dir)
+    artifacts = {}
+    for source in sources:
+        url = source[0]
+        missing = []
+        for lang_file in source[1]:
+            lang = utils.get_lang(lang_file)
+            key = stage_key(url, lang_file, use_jieba)
+            artifacts.setdefault(lang, []).append(_artifact_path(cache_dir, key, lang))
+            if is_cached(cache_dir, key, lang):
+                tf.logging.info("[cache] found %s: %s" % (lang_file, key))
+            else:
+                missing.append((lang_file, key, lang))
+
+        if not missing:
+            continue
+
+        filename = os.path.basename(url)
+        compressed_file = maybe_download(tmp_dir, filename, url)
+
+        # write to .incomplete, prepare_archive_stream appends to its targets
+        targets = []
+        for lang_file, key, lang in missing:
+            incomplete = _artifact_path(cache_dir, key, lang) + ".incomplete"
+            if tf.gfile.Exists(incomplete):
+                tf.gfile.Remove(incomplete)
+            targets.append((lang_file, incomplete))
+        utils.prepare_archive_stream(tmp_dir, compressed_file, targets, use_jieba,
+                                     num_workers)
+
+        for lang_file, key, lang in missing:
+            artifact = _artifact_path(cache_dir, key, lang)
+            tf.gfile.Rename(artifact + ".incomplete", artifact, overwrite=True)
+            _write_manifest(cache_dir, key, {
+                "url": url,
+                "file": lang_file,
+                "use_jieba": bool(use_jieba),
+                "version": utils.PREPROCESS_VERSION,
+                "bytes": tf.gfile.Stat(artifact).length,
+            })
+            tf.logging.info("[cache] stored %s: %s" % (lang_file, key))
+    return artifacts
+
+def _copy_blocks(f, out_file):
+    """Copy f to out_file, returns the number of lines"""
+    n = 0
+    while True:
+        block = f.read(_COPY_BLOCK_SIZE)
+        if not block:
+            break
+        n += block.count(b"\n")
+        out_file.write(block)
+    return n
+
+def concat_files(filepaths, out_filepath):
+    """Concatenate filepaths into out_filepath.
+    out_filepath only appears once fully written.
+
+    out_filepath is block-compressed if new files are, see compressed.py. 
+    Files in the same format are copied as bytes, others are converted.
+
+    Returns:
+        list of number of lines of each file.
+    """
+    tf.logging.info("[cache] writing %d files to %s" % (len(filepaths), out_filepath))
+    incomplete = out_filepath + ".incomplete"
+    compress = compressed.writes_compressed()
+    num_lines = []
+    with tf.gfile.GFile(incomplete, mode="wb"):
+        pass
+    for filepath in filepaths:
+        if compressed.is_compressed(filepath) == compress:
+            with tf.gfile.GFile(filepath, mode="rb") as f:
+                with tf.gfile.GFile(incomplete, mode="ab") as out_file:
+                    n = _copy_blocks(f, out_file)
+            if compress:
+                n = compressed.count_lines(filepath)
+        else:
+            with compressed.open_text(filepath, mode="rb") as f:
+                with compressed.open_text(incomplete, mode="ab") as out_file:
+                    n = _copy_blocks(f, out_file)
+        num_lines.append(n)
+    tf.gfile.Rename(incomplete, out_filepath, overwrite=True)
+    return num_lines
+
+def merge_artifacts(artifact_lists, data_dir, out_filename, names=None):
+    """Concatenate artifacts per language to e.g. data_dir/train.tok.en
+
+    Args:
+        artifact_lists: list of dicts lang -> file paths, e.g. as returned 
+            by prepare_data_cached
+        names: dataset name of each artifact list, recorded as the sources
+            of the merged files, see provenance.py
+    """
+    langs = {}
+    for i, artifacts in enumerate(artifact_lists):
+        for lang, paths in artifacts.items():
+            langs.setdefault(lang, []).extend((i, path) for path in paths)
+    for lang, items in langs.items():
+        out_filepath = os.path.join(data_dir, "%s.%s" % (out_filename, lang))
+        num_lines = concat_files([path for _, path in items], out_filepath)
+        if names is not None:
+            segments = []
+            for (i, _), n in zip(items, num_lines):
+                if segments and segments[-1][0] == names[i]:
+                    segments[-1][1] += n
+                else:
+                    segments.append([names[i], n])
+            provenance.write_sources(out_filepath, segments)
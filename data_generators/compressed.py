@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Block-compressed text files for datagen intermediates.
+
+A file is a sequence of independent gzip members ("blocks") of about
+BLOCK_SIZE uncompressed bytes, each ending on a line boundary, so it is
+still a valid gzip file (zcat, gzip.open). Each block header carries its
+compressed size in a gzip extra field, as in BGZF, so blocks can be found
+without decompressing: a reader can start at any block, and parallel
+readers split the file by byte range, see block_ranges.
+
+Files are compressed by content, not by name: open_text detects the format
+when reading, and writes compressed files once use_compression is on, so
+train.tok.en etc. keep their names. Appending keeps the format of the file.
+Concatenating whole files, e.g. cache.concat_files, is a byte copy.
+"""
+import tensorflow as tf
+import struct
+import zlib
+
+# uncompressed bytes per block
+BLOCK_SIZE = 2**20  # 1MB
+
+# zlib level, 6 is the gzip default
+COMPRESS_LEVEL = 6
+
+# gzip header with FEXTRA, and one extra subfield "TB" of the block size
+_HEADER = struct.Struct("<BBBBIBBH2sHI")
+_SUBFIELD = b"TB"
+_TRAILER = struct.Struct("<II")
+
+# write compressed files, see use_compression
+_COMPRESS = False
+
+def use_compression(enabled=True):
+    """Write new files of open_text block-compressed"""
+    global _COMPRESS
+    _COMPRESS = enabled
+
+def writes_compressed():
+    """True if new files of open_text are block-compressed"""
+    return _COMPRESS
+
+def _compress_block(data, level=COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    size = _HEADER.size + len(body) + _TRAILER.size
+    # FLG=4 (FEXTRA), OS=255 (unknown), XLEN=8
+    header = _HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 255, 8, _SUBFIELD, 4, size)
+    return header + body + _TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+def _block_size(header):
+    """Compressed size of the block starting with header, None if not a block"""
+    if len(header) < _HEADER.size:
+        return None
+    id1, id2, _, flags, _, _, _, xlen, subfield, slen, size = _HEADER.unpack(header[:_HEADER.size])
+    if (id1, id2) != (0x1f, 0x8b) or not flags & 4 or xlen != 8 or \
+            subfield != _SUBFIELD or slen != 4:
+        return None
+    return size
+
+def _read_block(f):
+    """Uncompressed data of the next block of binary file f, None at end of file"""
+    header = f.read(_HEADER.size)
+    if not header:
+        return None
+    size = _block_size(header)
+    if size is None:
+        raise ValueError("Not a block-compressed file: %s" % f.name)
+    body = f.read(size - _HEADER.size)
+    return zlib.decompress(body[:-_TRAILER.size], -zlib.MAX_WBITS)
+
+def is_compressed(filepath):
+    """True if filepath exists and is block-compressed"""
+    if not tf.gfile.Exists(filepath):
+        return False
+    with tf.gfile.GFile(filepath, mode="rb") as f:
+        return _block_size(f.read(_HEADER.size)) is not None
+
+def block_index(filepath):
+    """List of (offset, compressed size, uncompressed size) of the blocks.
+    Reads only block headers and trailers.
+    """
+    blocks = []
+    length = tf.gfile.Stat(filepath).length
+    with tf.gfile.GFile(filepath, mode="rb") as f:
+        offset = 0
+        while offset < length:
+            f.seek(offset)
+            size = _block_size(f.read(_HEADER.size))
+            if size is None:
+                raise ValueError("Not a block-compressed file: %s" % filepath)
+            f.seek(offset + size - 4)
+            blocks.append((offset, size, struct.unpack("<I", f.read(4))[0]))
+            offset += size
+    return blocks
+
+def block_ranges(filepath, chunk_size):
+    """Split filepath into byte ranges [start, end) of whole blocks,
+    of roughly chunk_size uncompressed bytes. See BlockReader.
+    """
+    ranges = []
+    start, nbytes = 0, 0
+    for offset, size, usize in block_index(filepath):
+        nbytes += usize
+        if nbytes >= chunk_size:
+            ranges.append((start, offset + size))
+            start, nbytes = offset + size, 0
+    if nbytes:
+        ranges.append((start, tf.gfile.Stat(filepath).length))
+    return ranges
+
+def count_lines(filepath):
+    """Number of lines of a block-compressed file"""
+    n = 0
+    with tf.gfile.GFile(filepath, mode="rb") as f:
+        while True:
+            data = _read_block(f)
+            if data is None:
+                break
+            n += data.count(b"\n")
+    return n
+
+class BlockReader(object):
+    """Reads lines of a block-compressed file, like tf.gfile.GFile.
+
+    Args:
+        mode: "r" for str lines, "rb" for bytes
+        start, end: read only the blocks starting in byte range [start, end)
+    """
+
+    def __init__(self, filepath, mode="r", start=0, end=None):
+        self.name = filepath
+        self._binary = "b" in mode
+        self._end = end
+        self._file = tf.gfile.GFile(filepath, mode="rb")
+        if start:
+            self._file.seek(start)
+        self._buffer = b""
+        self._pos = 0
+
+    def _fill(self):
+        """Append the next block to the buffer, False at the end"""
+        if self._end is not None and self._file.tell() >= self._end:
+            return False
+        data = _read_block(self._file)
+        if data is None:
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _convert(self, data):
+        return data if self._binary else tf.compat.as_str(data)
+
+    def readline(self):
+        while True:
+            i = self._buffer.find(b"\n", self._pos)
+            if i >= 0:
+                line = self._buffer[self._pos:i + 1]
+                self._pos = i + 1
+                return self._convert(line)
+            if not self._fill():
+                line = self._buffer[self._pos:]
+                self._buffer, self._pos = b"", 0
+                return self._convert(line)
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) - self._pos < size:
+            if not self._fill():
+                break
+        end = len(self._buffer) if size < 0 else self._pos + size
+        if not self._binary:
+            # do not split a utf-8 character
+            while end < len(self._buffer) and 0x80 <= ord(self._buffer[end:end + 1]) < 0xc0:
+                end += 1
+        data = self._buffer[self._pos:end]
+        self._pos += len(data)
+        return self._convert(data)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    next = __next__
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BlockWriter(object):
+    """Writes a block-compressed file, like tf.gfile.GFile.
+    Blocks are cut on the last line break within block_size bytes.
+
+    Args:
+        mode: "w" or "a", with or without "b". Written data may be str or bytes.
+    """
+
+    def __init__(self, filepath, mode="w", block_size=BLOCK_SIZE, level=COMPRESS_LEVEL):
+        self.name = filepath
+        self.block_size = block_size
+        self.level = level
+        self._file = tf.gfile.GFile(filepath, mode="ab" if mode.startswith("a") else "wb")
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        data = tf.compat.as_bytes(data)
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self.block_size:
+            self._write_blocks()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _write_blocks(self, final=False):
+        data = b"".join(self._buffer)
+        start = 0
+        while len(data) - start >= self.block_size or (final and start < len(data)):
+            if final and len(data) - start <= self.block_size:
+                end = len(data)
+            else:
+                end = data.rfind(b"\n", start, start + self.block_size) + 1
+                if end == 0:
+                    # a line longer than a block, cut after it
+                    end = data.find(b"\n", start + self.block_size) + 1
+                    if end == 0:
+                        if not final:
+                            break
+                        end = len(data)
+            self._file.write(_compress_block(data[start:end], self.level))
+            start = end
+        self._buffer = [data[start:]]
+        self._size = len(data) - start
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._write_blocks(final=True)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_text(filepath, mode="r"):
+    """tf.gfile.GFile, or BlockReader / BlockWriter for block-compressed files.
+    Reads detect the format. New files are compressed if use_compression is
+    on, appending to a non-empty file keeps its format.
+    """
+    if mode.startswith("r"):
+        if is_compressed(filepath):
+            return BlockReader(filepath, mode)
+        return tf.gfile.GFile(filepath, mode=mode)
+    compress = _COMPRESS
+    if mode.startswith("a") and tf.gfile.Exists(filepath) and tf.gfile.Stat(filepath).length:
+        compress = is_compressed(filepath)
+    if compress:
+        return BlockWriter(filepath, mode)
+    return tf.gfile.GFile(filepath, mode=mode)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the block-compressed format, see compressed.py.
+
+    python -m pytest data_generators/compressed_test.py
+"""
+import gzip
+
+import pytest
+
+from . import compressed
+
+# small blocks, so a few lines span several of them
+_BLOCK_SIZE = 64
+
+_LINES = [u"line %d %s\n" % (i, u"中文" * (i % 7)) for i in range(200)]
+
+@pytest.fixture(autouse=True)
+def _reset_compression():
+    yield
+    compressed.use_compression(False)
+
+def _write(filepath, lines, mode="w", block_size=_BLOCK_SIZE):
+    with compressed.BlockWriter(filepath, mode, block_size=block_size) as f:
+        f.writelines(lines)
+
+def _read(filepath):
+    with compressed.open_text(filepath, mode="r") as f:
+        return list(f)
+
+def test_roundtrip(tmpdir):
+    filepath = str(tmpdir.join("train.tok.zh"))
+    _write(filepath, _LINES)
+    assert compressed.is_compressed(filepath)
+    assert _read(filepath) == _LINES
+    assert compressed.count_lines(filepath) == len(_LINES)
+
+def test_gzip_compatible(tmpdir):
+    filepath = str(tmpdir.join("train.tok.zh"))
+    _write(filepath, _LINES)
+    with gzip.open(filepath, "rb") as f:
+        assert f.read().decode("utf-8") == u"".join(_LINES)
+
+def test_blocks_end_on_line_breaks(tmpdir):
+    filepath = str(tmpdir.join("train.tok.zh"))
+    _write(filepath, _LINES)
+    blocks = compressed.block_index(filepath)
+    assert len(blocks) > 1
+    with open(filepath, "rb") as f:
+        for offset, size, usize in blocks:
+            f.seek(offset)
+            data = compressed._read_block(f)
+            assert len(data) == usize
+            assert data.endswith(b"\n")
+
+def test_line_longer_than_block(tmpdir):
+    filepath = str(tmpdir.join("long.en"))
+    lines = [u"short\n", u"x" * (3 * _BLOCK_SIZE) + u"\n", u"last line without break"]
+    _write(filepath, lines)
+    assert _read(filepath) == lines
+
+def test_block_ranges(tmpdir):
+    filepath = str(tmpdir.join("train.tok.zh"))
+    _write(filepath, _LINES)
+    ranges = compressed.block_ranges(filepath, 4 * _BLOCK_SIZE)
+    assert len(ranges) > 1
+    assert ranges[0][0] == 0
+    assert all(a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:]))
+    lines = []
+    for start, end in ranges:
+        with compressed.BlockReader(filepath, "r", start, end) as f:
+            lines.extend(f)
+    assert lines == _LINES
+
+def test_append_keeps_format(tmpdir):
+    filepath = str(tmpdir.join("train.tok.en"))
+    compressed.use_compression(True)
+    with compressed.open_text(filepath, mode="w") as f:
+        f.writelines(_LINES[:50])
+    # appending to a compressed file stays compressed once compression is off
+    compressed.use_compression(False)
+    with compressed.open_text(filepath, mode="a") as f:
+        f.writelines(_LINES[50:])
+    assert compressed.is_compressed(filepath)
+    assert _read(filepath) == _LINES
+
+def test_plain_files(tmpdir):
+    filepath = str(tmpdir.join("train.tok.en"))
+    with compressed.open_text(filepath, mode="w") as f:
+        f.write(u"".join(_LINES))
+    assert not compressed.is_compressed(filepath)
+    assert _read(filepath) == _LINES
+
+def test_partial_reads(tmpdir):
+    filepath = str(tmpdir.join("train.tok.zh"))
+    _write(filepath, _LINES)
+    # text reads do not split a utf-8 character
+    with compressed.BlockReader(filepath, "r") as f:
+        chunks = []
+        while True:
+            chunk = f.read(5)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    assert u"".join(chunks) == u"".join(_LINES)
+    # binary reads return exactly size bytes
+    with compressed.BlockReader(filepath, "rb") as f:
+        head = f.read(10)
+        assert head == u"".join(_LINES).encode("utf-8")[:10]
+        assert f.readline() + f.read() == u"".join(_LINES).encode("utf-8")[10:]
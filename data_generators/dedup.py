@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory-bounded duplicate filtering for parallel corpora.
+
+Instead of keeping every (source, target) string pair in a python set,
+FingerprintSet keeps a fixed-width md5 fingerprint of each pair in a flat
+array with open addressing, ~16 bytes per pair for 64-bit fingerprints.
+
+Two different pairs are treated as duplicates only if their fingerprints
+collide. For n unique pairs and b-bit fingerprints, the probability of any
+collision is about n^2 / 2^(b+1): for n = 24M that is ~1.6e-5 with 64 bits,
+and negligible (~1e-24) with 128 bits.
+"""
+import hashlib
+import struct
+from array import array
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+DEDUP_MODES = ("exact", "hash64", "hash128")
+
+def fingerprint(src, ref, bits=64):
+    """md5 fingerprint of a sentence pair, as a tuple of bits/64 uint64 words"""
+    digest = hashlib.md5(src.encode("utf-8") + b"\0" + ref.encode("utf-8")).digest()
+    words = struct.unpack("<QQ", digest)[:bits // 64]
+    # 0 marks an empty slot in FingerprintSet
+    return (words[0] or 1,) + words[1:]
+
+def pair_key(src, ref, mode="exact"):
+    """Key of a sentence pair in the dedup set for mode. 
+    Can be computed in worker processes and passed to add_key.
+    """
+    if mode == "exact":
+        return (src, ref)
+    return fingerprint(src, ref, 128 if mode == "hash128" else 64)
+
+class ExactSet(object):
+    """Exact set of (source, target) pairs, keeps the strings in memory"""
+
+    def __init__(self):
+        self._pairs = set()
+
+    def add_key(self, example):
+        """Add pair_key, returns False if it was already seen"""
+        if example in self._pairs:
+            return False
+        self._pairs.add(example)
+        return True
+
+    def add_pair(self, src, ref):
+        """Add pair, returns False if it was already seen"""
+        return self.add_key((src, ref))
+
+    def __len__(self):
+        return len(self._pairs)
+
+    @property
+    def nbytes(self):
+        # lower bound, string objects only
+        return sum(len(s) + len(r) for s, r in self._pairs)
+
+
+class FingerprintSet(object):
+    """Set of 64 or 128-bit fingerprints of (source, target) pairs.
+    Fingerprints are stored in a flat uint64 array, with linear probing.
+    """
+
+    def __init__(self, bits=64, capacity=2**20, max_load=0.6):
+        if bits not in (64, 128):
+            raise ValueError("bits must be 64 or 128, got %s" % bits)
+        self.bits = bits
+        self._words = bits // 64
+        self._max_load = max_load
+        self._size = 0
+        self._alloc(capacity)
+
+    def _alloc(self, capacity):
+        self._capacity = capacity
+        self._mask = capacity - 1
+        self._slots = array("Q", bytes(8 * self._words * capacity))
+
+    def _insert(self, fp):
+        """Insert fingerprint, returns False if already present"""
+        slots, words = self._slots, self._words
+        i = fp[0] & self._mask
+        while True:
+            j = i * words
+            head = slots[j]
+            if head == 0:
+                slots[j:j + words] = array("Q", fp)
+                self._size += 1
+                return True
+            if head == fp[0] and tuple(slots[j:j + words]) == fp:
+                return False
+            i = (i + 1) & self._mask
+
+    def _grow(self):
+        old, words = self._slots, self._words
+        self._alloc(self._capacity * 2)
+        self._size = 0
+        for j in range(0, len(old), words):
+            if old[j]:
+                self._insert(tuple(old[j:j + words]))
+
+    def add_key(self, fp):
+        """Add fingerprint, returns False if it was already seen"""
+        if self._size + 1 > self._max_load * self._capacity:
+            self._grow()
+        return self._insert(fp)
+
+    def add_pair(self, src, ref):
+        """Add pair, returns False if it was already seen"""
+        return self.add_key(fingerprint(src, ref, self.bits))
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        return self._slots.itemsize * len(self._slots)
+
+
+def make_dedup_set(mode="exact"):
+    """Set of seen pairs for dedup mode: exact, hash64 or hash128"""
+    if mode == "exact":
+        return ExactSet()
+    if mode == "hash64":
+        return FingerprintSet(64)
+    if mode == "hash128":
+        return FingerprintSet(128)
+    raise ValueError("Unknown dedup mode %s, expected one of %s" % (mode, DEDUP_MODES))
+
+def peak_memory_mb():
+    """Peak resident memory of this process in MB, None if unavailable"""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
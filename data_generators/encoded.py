@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Pre-encoded binary format for parallel corpora.
+
+Each side of the corpus is stored as a flat array of token ids (uint16 if
+the vocab fits, else uint32) plus a uint64 offsets index of n + 1 entries,
+so sentence i is tokens[offsets[i]:offsets[i + 1]]. Both are memory-mapped
+when read, so datagen can be re-run without re-encoding text. Memory-mapping
+needs data_dir on a local filesystem.
+
+    <prefix>.inputs.bin, <prefix>.inputs.idx
+    <prefix>.targets.bin, <prefix>.targets.idx
+    <prefix>.json   metadata, written last as completion marker
+"""
+import tensorflow as tf
+import os
+import json
+import multiprocessing
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from tensor2tensor.data_generators import text_encoder
+
+from . import utils
+from . import encoder_cache
+from . import provenance
+from . import compressed
+
+# bump when the format changes
+_FORMAT_VERSION = 1
+
+# number of sentence pairs per encoding chunk
+_ENCODE_CHUNK_LINES = 10000
+
+# vocabs of encoding worker processes, set by _init_encode_worker
+_VOCABS = None
+
+def _dtype_for(vocab_size):
+    return np.uint16 if vocab_size <= 2**16 else np.uint32
+
+def _paths(prefix, side):
+    return prefix + ".%s.bin" % side, prefix + ".%s.idx" % side
+
+class _ArrayWriter(object):
+    """Appends chunks of token ids to a flat binary array and its offsets index"""
+
+    def __init__(self, prefix, side, dtype):
+        self._paths = _paths(prefix, side)
+        self._dtype = dtype
+        self._tokens = tf.gfile.GFile(self._paths[0] + ".incomplete", mode="wb")
+        self._index = tf.gfile.GFile(self._paths[1] + ".incomplete", mode="wb")
+        self._index.write(np.zeros(1, dtype=np.uint64).tobytes())
+        self.num_tokens = 0
+
+    def append_chunk(self, flat, lengths):
+        """Append sentences, given as concatenated token ids and their lengths"""
+        self._tokens.write(np.asarray(flat, dtype=self._dtype).tobytes())
+        offsets = np.cumsum(lengths, dtype=np.uint64) + np.uint64(self.num_tokens)
+        self._index.write(offsets.tobytes())
+        self.num_tokens += len(flat)
+
+    def close(self):
+        self._tokens.close()
+        self._index.close()
+        for path in self._paths:
+            tf.gfile.Rename(path + ".incomplete", path, overwrite=True)
+
+def _drop_reason(source_ints, target_ints, max_length, max_tokens):
+    """Returns reason to drop an encoded pair, or None to keep it"""
+    if max_length and max(len(source_ints), len(target_ints)) > max_length:
+        return "too_long"
+    if max_tokens and len(source_ints) + len(target_ints) > max_tokens:
+        return "over_budget"
+    return None
+
+def _encode_pairs(source_vocab, target_vocab, first_line, source_lines, target_lines,
+                  max_length=None, max_tokens=None):
+    """Encode a chunk of sentence pairs.
+    Returns (source ids, source lengths, target ids, target lengths, skipped, dropped)
+    with the token ids of all sentences concatenated, the number of pairs 
+    that failed to encode, and (line_num, reason) of pairs dropped by the
+    length limits, see encode_parallel_corpus.
+    """
+    source_flat, source_lengths = [], []
+    target_flat, target_lengths = [], []
+    skipped, dropped = 0, []
+    for i, (source, target) in enumerate(zip(source_lines, target_lines)):
+        try:
+            source_ints = source_vocab.encode(source.strip())
+            target_ints = target_vocab.encode(target.strip())
+        except Exception:
+            tf.logging.info("[line %d] source: %s\n%s target: %s" % (first_line + i, source,
+                " " * 10, target))
+            skipped += 1
+            continue
+        reason = _drop_reason(source_ints, target_ints, max_length, max_tokens)
+        if reason is not None:
+            dropped.append((first_line + i, reason))
+            continue
+        source_flat.extend(source_ints)
+        source_lengths.append(len(source_ints))
+        target_flat.extend(target_ints)
+        target_lengths.append(len(target_ints))
+    return (np.asarray(source_flat, dtype=_dtype_for(source_vocab.vocab_size)), source_lengths,
+            np.asarray(target_flat, dtype=_dtype_for(target_vocab.vocab_size)), target_lengths,
+            skipped, dropped)
+
+def _init_encode_worker(vocab_filepaths):
+    """Load vocab files once per worker process"""
+    global _VOCABS
+    _VOCABS = [encoder_cache.cached(text_encoder.SubwordTextEncoder(path))
+               for path in vocab_filepaths]
+
+def _encode_chunk(args):
+    return _encode_pairs(_VOCABS[0], _VOCABS[1], *args)
+
+def encode_parallel_corpus(source_path, target_path, source_vocab, target_vocab,
+                           prefix, meta=None, num_workers=1, vocab_filepaths=None,
+                           chunk_lines=_ENCODE_CHUNK_LINES, max_length=None, max_tokens=None):
+    """Encode parallel text files with source_vocab, target_vocab
+    and write to binary format at prefix.
+
+    Pairs that fail to encode are skipped, as in utils.bi_vocabs_token_generator.
+
+    If num_workers > 1, chunks of chunk_lines pairs are encoded in a pool of
+    worker processes, which load the vocab from vocab_filepaths once.
+    Chunks are written in order. Encoding is memoized, see encoder_cache.
+
+    Pairs are dropped right after encoding if either side has more than
+    max_length subword ids, or both sides together more than max_tokens.
+    Drop counts are logged and stored in the metadata per source dataset,
+    see provenance.py.
+
+    Args:
+        meta: dict stored with the metadata, to check the encoded corpus is
+            still valid, see get_or_encode.
+        vocab_filepaths: (source, target) vocab file paths, required if 
+            num_workers > 1
+        max_length: max subword ids per side, None or 0 for no limit
+        max_tokens: max subword ids of source and target, None or 0 for no limit
+    """
+    tf.logging.info("[encoded] encoding %s, %s to %s, %d workers" % 
+                    (source_path, target_path, prefix, num_workers))
+    with compressed.open_text(source_path, mode="r") as source_file:
+        with compressed.open_text(target_path, mode="r") as target_file:
+            encode_chunks(utils.read_pair_chunks(source_file, target_file, chunk_lines),
+                          provenance.SourceMap.for_file(source_path), source_vocab, target_vocab,
+                          prefix, meta, num_workers, vocab_filepaths, max_length, max_tokens)
+
+def encode_chunks(chunks, sources, source_vocab, target_vocab, prefix, meta=None,
+                  num_workers=1, vocab_filepaths=None, max_length=None, max_tokens=None):
+    """Encode chunks of sentence pairs and write to binary format at prefix,
+    see encode_parallel_corpus. 
+
+    Args:
+        chunks: iterator of (first_line_num, source_lines, target_lines), 
+            e.g. utils.read_pair_chunks. Read at most 2 * num_workers chunks ahead.
+        sources: provenance.SourceMap of the line numbers, for drop counts
+    """
+    inputs = _ArrayWriter(prefix, "inputs", _dtype_for(source_vocab.vocab_size))
+    targets = _ArrayWriter(prefix, "targets", _dtype_for(target_vocab.vocab_size))
+    num_pairs, num_skipped = 0, 0
+    dropped = defaultdict(Counter)
+    pool = None
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_encode_worker,
+                                    initargs=(vocab_filepaths,))
+    try:
+        chunks = (chunk + (max_length, max_tokens) for chunk in chunks)
+        if pool is None:
+            source_vocab = encoder_cache.cached(source_vocab)
+            target_vocab = encoder_cache.cached(target_vocab)
+            results = (_encode_pairs(source_vocab, target_vocab, *chunk) for chunk in chunks)
+        else:
+            results = utils.ordered_imap(pool, _encode_chunk, chunks, 2 * num_workers)
+
+        for source_flat, source_lengths, target_flat, target_lengths, skipped, \
+                chunk_dropped in results:
+            inputs.append_chunk(source_flat, source_lengths)
+            targets.append_chunk(target_flat, target_lengths)
+            num_pairs += len(source_lengths)
+            num_skipped += skipped
+            for line_num, reason in chunk_dropped:
+                dropped[sources.name(line_num)][reason] += 1
+        if pool is None:
+            source_vocab.log_stats("source")
+            target_vocab.log_stats("target")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    inputs.close()
+    targets.close()
+
+    info = dict(meta or {})
+    info.update({
+        "version": _FORMAT_VERSION,
+        "num_pairs": num_pairs,
+        "num_skipped": num_skipped,
+        "dropped": dropped,
+        "inputs_dtype": np.dtype(_dtype_for(source_vocab.vocab_size)).name,
+        "targets_dtype": np.dtype(_dtype_for(target_vocab.vocab_size)).name,
+    })
+    with tf.gfile.GFile(prefix + ".json", mode="w") as f:
+        json.dump(info, f)
+    tf.logging.info("[encoded] done, pairs: %d, skipped: %d, tokens: %d / %d" %
+        (num_pairs, num_skipped, inputs.num_tokens, targets.num_tokens))
+    tf.logging.info("[encoded] dropped by length limits: %s" % provenance.format_counts(dropped))
+
+def read_meta(prefix):
+    """Metadata of encoded corpus at prefix, None if missing or incomplete"""
+    if not tf.gfile.Exists(prefix + ".json"):
+        return None
+    with tf.gfile.GFile(prefix + ".json", mode="r") as f:
+        return json.load(f)
+
+class EncodedCorpus(object):
+    """Memory-mapped parallel corpus in binary format"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.meta = read_meta(prefix)
+        if self.meta is None:
+            raise ValueError("No encoded corpus at %s" % prefix)
+        self._inputs = self._load("inputs")
+        self._targets = self._load("targets")
+
+    def _load(self, side):
+        tokens_path, index_path = _paths(self.prefix, side)
+        dtype = np.dtype(self.meta["%s_dtype" % side])
+        # np.memmap fails on empty files
+        tokens = (np.memmap(tokens_path, dtype=dtype, mode="r")
+                  if os.path.getsize(tokens_path) else np.zeros(0, dtype=dtype))
+        offsets = np.memmap(index_path, dtype=np.uint64, mode="r")
+        return tokens, offsets
+
+    def __len__(self):
+        return self.meta["num_pairs"]
+
+    def _get(self, arrays, i):
+        tokens, offsets = arrays
+        return tokens[int(offsets[i]):int(offsets[i + 1])]
+
+    def __getitem__(self, i):
+        """Returns (inputs, targets) token id arrays of pair i"""
+        return self._get(self._inputs, i), self._get(self._targets, i)
+
+    def lengths(self):
+        """Arrays of inputs and targets lengths, without eos"""
+        return np.diff(self._inputs[1]), np.diff(self._targets[1])
+
+def encoded_token_generator(corpus, eos=None, start=0, stop=None, indices=None):
+    """Generator over an EncodedCorpus, same output as utils.bi_vocabs_token_generator.
+    Yields pairs [start, stop), or the pairs at indices, in that order, if given.
+
+    Yields:
+        A dictionary {"inputs": source-line, "targets": target-line} of
+        token id lists, with eos appended if not None.
+    """
+    eos_list = [] if eos is None else [eos]
+    if indices is None:
+        stop = len(corpus) if stop is None else stop
+        indices = range(start, stop)
+    for i in indices:
+        inputs, targets = corpus[i]
+        yield {"inputs": inputs.tolist() + eos_list, "targets": targets.tolist() + eos_list}
+
+def is_current(prefix, meta):
+    """True if the encoded corpus at prefix was encoded with meta.
+    Otherwise removes its metadata, so a partial re-encode is never read.
+    """
+    found = read_meta(prefix)
+    if found is not None and found.get("version") == _FORMAT_VERSION and \
+            all(found.get(k) == v for k, v in meta.items()):
+        return True
+    if found is not None:
+        tf.gfile.Remove(prefix + ".json")
+    return False
+
+def get_or_encode(source_path, target_path, source_vocab, target_vocab, prefix,
+                  vocab_filepaths, num_workers=1, max_length=None, max_tokens=None):
+    """EncodedCorpus at prefix, encoding the text files first if it is missing
+    or was encoded from different text or vocab files, or length limits.
+
+    Args:
+        vocab_filepaths: (source, target) vocab file paths, fingerprinted to
+            detect a changed vocab.
+        num_workers: number of encoding processes, see encode_parallel_corpus
+        max_length, max_tokens: length limits, see encode_parallel_corpus
+    """
+    meta = {
+        "source": utils.file_fingerprint(source_path),
+        "target": utils.file_fingerprint(target_path),
+        "source_vocab": utils.file_fingerprint(vocab_filepaths[0]),
+        "target_vocab": utils.file_fingerprint(vocab_filepaths[1]),
+        "max_length": max_length or None,
+        "max_tokens": max_tokens or None,
+    }
+    if is_current(prefix, meta):
+        tf.logging.info("[encoded] found encoded corpus: %s" % prefix)
+    else:
+        encode_parallel_corpus(source_path, target_path, source_vocab, target_vocab,
+                               prefix, meta, num_workers, vocab_filepaths,
+                               max_length=max_length, max_tokens=max_tokens)
+    return EncodedCorpus(prefix)
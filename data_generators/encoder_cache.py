@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+LRU memoization of subword encoding.
+
+CachedEncoder wraps a SubwordTextEncoder with a bounded whole-line cache,
+for corpora with many repeated sentences. Tokens are not cached here:
+SubwordTextEncoder already memoizes subtoken ids per token. Everything 
+else (decode, vocab_size, ...) is passed through to the wrapped encoder.
+"""
+import tensorflow as tf
+from collections import OrderedDict
+
+# default cache size, in lines
+LINE_CACHE_SIZE = 2**16
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entry"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Returns cached value, or None on a miss"""
+        value = self._entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        # re-insert as most recently used
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+
+class CachedEncoder(object):
+    """SubwordTextEncoder with an LRU line cache on encode.
+
+    Args:
+        vocab: SubwordTextEncoder to wrap
+        line_cache_size: max lines in the whole-line cache
+    """
+
+    def __init__(self, vocab, line_cache_size=LINE_CACHE_SIZE):
+        self.vocab = vocab
+        self.line_cache = LRUCache(line_cache_size)
+
+    def __getattr__(self, name):
+        # only called for attributes not found on CachedEncoder
+        if name == "vocab":
+            raise AttributeError(name)
+        return getattr(self.vocab, name)
+
+    def encode(self, raw_text):
+        """Same as SubwordTextEncoder.encode, with cached lines"""
+        ids = self.line_cache.get(raw_text)
+        if ids is None:
+            ids = tuple(self.vocab.encode(raw_text))
+            self.line_cache.put(raw_text, ids)
+        return list(ids)
+
+    def stats(self):
+        """Hit/miss counters of the line cache"""
+        return {
+            "line_hits": self.line_cache.hits,
+            "line_misses": self.line_cache.misses,
+        }
+
+    def log_stats(self, name="encoder"):
+        tf.logging.info("[encoder_cache] %s: line hit rate %.3f (%d entries)" % (
+            name, self.line_cache.hit_rate(), len(self.line_cache)))
+
+def cached(vocab, **kwargs):
+    """Wrap vocab in a CachedEncoder, unless it already is one"""
+    if isinstance(vocab, CachedEncoder):
+        return vocab
+    return CachedEncoder(vocab, **kwargs)
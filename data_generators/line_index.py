@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Line-offset index for corpus files.
+
+The index is a sidecar file <filepath>.idx holding a packed uint64 array of
+n + 1 byte offsets: the start of each of the n lines, then the file size.
+It is built once with a vectorized scan and memory-mapped afterwards, giving
+O(1) access to line i, random samples, and byte-balanced line ranges.
+
+    python -m data_generators.line_index data/wmt/train.tok.clean 12345
+    # prints line 12345 of train.tok.clean.en and train.tok.clean.zh
+"""
+from __future__ import print_function
+import tensorflow as tf
+import os
+import random
+import argparse
+
+import numpy as np
+
+from . import compressed
+
+# bytes read per block while building the index
+_BLOCK_SIZE = 2**24
+
+def _index_path(filepath):
+    return filepath + ".idx"
+
+def _is_fresh(filepath):
+    index_path = _index_path(filepath)
+    if not os.path.exists(index_path):
+        return False
+    if os.path.getmtime(index_path) < os.path.getmtime(filepath):
+        return False
+    # last entry is the size of the indexed file
+    size = os.path.getsize(index_path)
+    if size < 8 or size % 8:
+        return False
+    with open(index_path, "rb") as f:
+        f.seek(size - 8)
+        last = np.frombuffer(f.read(8), dtype=np.uint64)[0]
+    return int(last) == os.path.getsize(filepath)
+
+def build_line_index(filepath):
+    """Write line offsets of filepath to its .idx sidecar"""
+    index_path = _index_path(filepath)
+    size = os.path.getsize(filepath)
+    tf.logging.info("[line_index] indexing %s" % filepath)
+    with open(filepath, "rb") as f, open(index_path + ".incomplete", "wb") as out:
+        np.zeros(1, dtype=np.uint64).tofile(out)
+        base = 0
+        while True:
+            block = f.read(_BLOCK_SIZE)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+            starts = (newlines + (base + 1)).astype(np.uint64)
+            # a newline at the end of file does not start a new line
+            starts[starts >= size] = 0
+            starts[starts != 0].tofile(out)
+            base += len(block)
+        if size > 0:
+            np.array([size], dtype=np.uint64).tofile(out)
+    os.rename(index_path + ".incomplete", index_path)
+
+class LineIndex(object):
+    """Random access to the lines of a text file, via its .idx sidecar.
+    The index is built if missing or older than the file.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        if compressed.is_compressed(filepath):
+            raise ValueError("%s is block-compressed, line_index needs plain text" % filepath)
+        if not _is_fresh(filepath):
+            build_line_index(filepath)
+        self.offsets = np.memmap(_index_path(filepath), dtype=np.uint64, mode="r")
+        self._file = open(filepath, "rb")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, i):
+        """Line i as unicode, without the line break"""
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        self._file.seek(start)
+        return self._file.read(end - start).decode("utf-8").rstrip("\n")
+
+    def lines(self, start, stop):
+        """Iterate lines [start, stop), streaming from a single seek.
+        Uses its own file handle, so line() can be called meanwhile.
+        """
+        with open(self.filepath, "rb") as f:
+            f.seek(int(self.offsets[start]))
+            for _ in range(start, stop):
+                yield f.readline().decode("utf-8").rstrip("\n")
+
+    def close(self):
+        self._file.close()
+
+class ParallelIndex(object):
+    """Line indexes of both sides of a parallel corpus, e.g.
+    ParallelIndex("train.tok.clean.en", "train.tok.clean.zh")
+    """
+
+    def __init__(self, source_path, target_path):
+        self.source = LineIndex(source_path)
+        self.target = LineIndex(target_path)
+        if len(self.source) != len(self.target):
+            tf.logging.warning("[line_index] line counts differ: %s %d, %s %d" % (
+                source_path, len(self.source), target_path, len(self.target)))
+
+    def __len__(self):
+        return min(len(self.source), len(self.target))
+
+    def pair(self, i):
+        """(source, target) of line i"""
+        return self.source.line(i), self.target.line(i)
+
+    def sample(self, k, seed=None):
+        """k random pairs, as (line_num, source, target), without replacement"""
+        rng = random.Random(seed)
+        indices = rng.sample(range(len(self)), min(k, len(self)))
+        return [(i,) + self.pair(i) for i in indices]
+
+    def pairs(self, start=0, stop=None):
+        """Iterate (source, target) pairs of lines [start, stop)"""
+        stop = len(self) if stop is None else stop
+        if start >= stop:
+            return iter(())
+        return zip(self.source.lines(start, stop), self.target.lines(start, stop))
+
+    def shards(self, num_shards):
+        """Split lines into num_shards (start, stop) ranges of about
+        equal bytes, counting both sides.
+        """
+        n = len(self)
+        cumulative = (self.source.offsets[:n + 1].astype(np.float64) +
+                      self.target.offsets[:n + 1].astype(np.float64))
+        targets = np.linspace(0, cumulative[-1], num_shards + 1)[1:-1]
+        bounds = [0] + np.searchsorted(cumulative, targets).tolist() + [n]
+        return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+    def close(self):
+        self.source.close()
+        self.target.close()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('prefix', help='corpus prefix, e.g. data/wmt/train.tok.clean')
+parser.add_argument('line', type=int, nargs='*', help='line numbers to print')
+parser.add_argument('-s', '--sample', type=int, default=0,
+    help='print N random pairs instead')
+
+def main():
+    opt = parser.parse_args()
+    index = ParallelIndex(opt.prefix + ".en", opt.prefix + ".zh")
+    print("lines: %d" % len(index))
+    if opt.sample:
+        pairs = index.sample(opt.sample)
+    else:
+        pairs = [(i,) + index.pair(i) for i in opt.line]
+    for i, source, target in pairs:
+        print("[line %d] source: %s\n%s target: %s" % (i, source, " " * 10, target))
+
+if __name__ == '__main__':
+    main()
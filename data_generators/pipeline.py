@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fused single-pass pipeline for the training corpus.
+
+By default the corpus is written three times: merge_artifacts writes
+train.tok.*, clean_parallel reads it back to train.tok.clean.*, and encoding
+reads that back to the binary format. Here the same steps run as chained
+generator stages over one stream of the preprocessed stage artifacts, see
+cache.py:
+
+    artifact_pairs -> clean_pairs -> pair_chunks -> write_clean / encode
+
+Each stage pulls lines from the previous one, so only one chunk is held
+between stages, and encoding workers run at most 2 * num_workers chunks
+ahead. Only the last stage writes to disk: train.tok.clean.* while the vocab
+is still to be built from it, and only the encoded corpus once it exists.
+"""
+import tensorflow as tf
+import json
+import hashlib
+import itertools
+from collections import Counter
+
+from six.moves import zip
+
+from . import utils
+from . import dedup as dedup_utils
+from . import encoded
+from . import provenance
+from . import compressed
+
+# number of sentence pairs per chunk handed to the encoder
+_CHUNK_LINES = 10000
+
+def artifact_pairs(artifact_lists, names, langs=("en", "zh")):
+    """Stage 1: sentence pairs of the stage artifacts, in order of artifact_lists.
+    Artifact files of both languages are read in lockstep.
+
+    Args:
+        artifact_lists: list of dicts lang -> file paths, see cache.prepare_data_cached
+        names: dataset name of each artifact list
+
+    Yields:
+        (dataset name, source line, target line)
+    """
+    for artifacts, name in zip(artifact_lists, names):
+        for src_path, ref_path in zip(artifacts[langs[0]], artifacts[langs[1]]):
+            tf.logging.info("[pipeline] streaming %s: %s, %s" % (name, src_path, ref_path))
+            with compressed.open_text(src_path, mode="r") as f_src, \
+                    compressed.open_text(ref_path, mode="r") as f_ref:
+                for _src, _ref in zip(f_src, f_ref):
+                    yield name, _src, _ref
+
+def clean_pairs(pairs, counts, max_ratio=9.0, min_ratio=0.1111, min_src_len=5, dedup="exact"):
+    """Stage 2: length filters and dedup of utils.clean_parallel.
+
+    Args:
+        pairs: iterator of (dataset name, source line, target line)
+        counts: Counter, updated with the rejection reasons
+
+    Yields:
+        kept (dataset name, source line, target line)
+    """
+    sents = dedup_utils.make_dedup_set(dedup)
+    for name, _src, _ref in pairs:
+        reason = utils.filter_reason(_src, _ref, max_ratio, min_ratio, min_src_len)
+        if reason is None and not sents.add_pair(_src, _ref):
+            reason = "duplicate"
+        if reason is not None:
+            counts[reason] += 1
+            continue
+        yield name, _src, _ref
+    tf.logging.info("[pipeline] clean done, total: %d, rejected: %s" % (len(sents),
+        ", ".join("%s=%d" % item for item in sorted(counts.items()))))
+
+def pair_chunks(pairs, sources, chunk_lines=_CHUNK_LINES):
+    """Stage 3: chunks of pairs, as utils.read_pair_chunks.
+    The dataset of each line is appended to sources, a provenance.SourceMap.
+
+    Yields:
+        (first_line_num, source_lines, target_lines)
+    """
+    pairs = iter(pairs)
+    line_num = 0
+    while True:
+        chunk = list(itertools.islice(pairs, chunk_lines))
+        if not chunk:
+            break
+        for name, _, _ in chunk:
+            sources.append(name)
+        yield line_num, [_src for _, _src, _ in chunk], [_ref for _, _, _ref in chunk]
+        line_num += len(chunk)
+
+def write_clean(artifact_lists, names, output_filenames, clean_params=None, dedup="exact"):
+    """Stream the stage artifacts through clean_pairs to output_filenames,
+    e.g. train.tok.clean.*, without writing the merged train.tok.*.
+    Kept lines per dataset are recorded, see provenance.py.
+
+    Returns:
+        Counter of rejection reasons, see utils.clean_parallel
+    """
+    counts = Counter()
+    sources = provenance.SourceMap()
+    pairs = clean_pairs(artifact_pairs(artifact_lists, names), counts,
+                        dedup=dedup, **(clean_params or {}))
+    src_out, ref_out = output_filenames
+    with compressed.open_text(src_out + ".incomplete", mode="w") as f_src_out, \
+            compressed.open_text(ref_out + ".incomplete", mode="w") as f_ref_out:
+        for _, src_lines, ref_lines in pair_chunks(pairs, sources):
+            f_src_out.writelines(src_lines)
+            f_ref_out.writelines(ref_lines)
+    for filename in output_filenames:
+        tf.gfile.Rename(filename + ".incomplete", filename, overwrite=True)
+        provenance.write_sources(filename, sources.segments())
+    return counts
+
+def stream_meta(artifact_lists, names, vocab_filepaths, clean_params=None, dedup="exact",
+                max_length=None, max_tokens=None):
+    """Metadata of a corpus encoded by get_or_encode_stream, see encoded.is_current"""
+    artifacts = [[name, lang, [utils.file_fingerprint(path) for path in paths]]
+                 for artifacts, name in zip(artifact_lists, names)
+                 for lang, paths in sorted(artifacts.items())]
+    key = json.dumps([artifacts, clean_params or {}, dedup])
+    return {
+        "stream": hashlib.sha1(key.encode("utf-8")).hexdigest(),
+        "source_vocab": utils.file_fingerprint(vocab_filepaths[0]),
+        "target_vocab": utils.file_fingerprint(vocab_filepaths[1]),
+        "max_length": max_length or None,
+        "max_tokens": max_tokens or None,
+    }
+
+def get_or_encode_stream(artifact_lists, names, source_vocab, target_vocab, prefix,
+                         vocab_filepaths, clean_params=None, dedup="exact", num_workers=1,
+                         max_length=None, max_tokens=None):
+    """EncodedCorpus at prefix, streaming the stage artifacts through clean_pairs
+    into the encoder if it is missing or out of date. No text file is written.
+
+    Args:
+        clean_params: dict of max_ratio, min_ratio, min_src_len for clean_pairs
+        num_workers, max_length, max_tokens: see encoded.encode_parallel_corpus
+    """
+    meta = stream_meta(artifact_lists, names, vocab_filepaths, clean_params, dedup,
+                       max_length, max_tokens)
+    if encoded.is_current(prefix, meta):
+        tf.logging.info("[pipeline] found encoded corpus: %s" % prefix)
+    else:
+        tf.logging.info("[pipeline] encoding %d datasets to %s, %d workers" %
+                        (len(names), prefix, num_workers))
+        counts = Counter()
+        sources = provenance.SourceMap()
+        pairs = clean_pairs(artifact_pairs(artifact_lists, names), counts,
+                            dedup=dedup, **(clean_params or {}))
+        encoded.encode_chunks(pair_chunks(pairs, sources), sources, source_vocab,
+                              target_vocab, prefix, meta, num_workers, vocab_filepaths,
+                              max_length, max_tokens)
+    return encoded.EncodedCorpus(prefix)
@@ -1,7 +1,7 @@
 import os
 import random
-import io
 from . import utils
+from . import compressed
 import tensorflow as tf
 
 def preprocess_nc(data_dir, dataset_prefix="train.full.tok", 
@@ -26,128 +26,134 @@ def preprocess_nc(data_dir, dataset_prefix="train.full.tok",
     split_dev([src, ref], [src_train, ref_train], [src_dev, ref_dev], sample_size=dev_size)
 
 
+# bytes read at a time when counting lines
+_COUNT_BLOCK_SIZE = 2**22  # 4MB
+
+def _count_lines(filepath):
+    """Number of lines of filepath, plain or block-compressed, in one streaming pass"""
+    n = 0
+    last = b"\n"
+    with compressed.open_text(filepath, mode="rb") as f:
+        while True:
+            block = f.read(_COUNT_BLOCK_SIZE)
+            if not block:
+                break
+            n += block.count(b"\n")
+            last = block[-1:]
+    # a last line without line break
+    return n if last == b"\n" else n + 1
+
 def split_dev(corpus_filepaths, 
     train_filepaths=["train.tok.en", "train.tok.zh"], 
     dev_filepaths=["dev.tok.en", "dev.tok.zh"],
     sample_size=2000):
+    """Hold out a random sample of sample_size sentence pairs as dev set.
 
+    Streams the corpus in two passes: count lines, then 
+    write each line to train or dev. Only the sampled dev lines are kept in memory. 
+    Train lines keep their corpus order, dev lines are in random order.
+    """
     src_filename, ref_filename = corpus_filepaths
     src_train, ref_train = train_filepaths
     src_dev, ref_dev = dev_filepaths
-    
-    with open(src_filename, 'r') as f_src, \
-        open(ref_filename, 'r') as f_ref, \
-        open(src_train, 'w') as f_train_src, \
-        open(ref_train, 'w') as f_train_ref, \
-        open(src_dev, 'w') as f_dev_src, \
-        open(ref_dev, 'w') as f_dev_ref:
-
-        lines_src = f_src.readlines()
-        lines_ref = f_ref.readlines()
 
-        # shuffle
-        index_shuf = random.sample(list(range(len(lines_src))), len(lines_src))
-        N = min(len(lines_src), sample_size)
-
-        tf.logging.info("Sample size: %d, total corpus: %d" %
-                        (N, len(lines_src)))
-        tf.logging.info("Writing dev src to: %s" % src_dev)
-        tf.logging.info("Writing dev ref to: %s" % ref_dev)
-
-        for i in index_shuf[:N]:
-            f_dev_src.write(lines_src[i])
-            f_dev_ref.write(lines_ref[i])
-
-        # write remaining to train
-        tf.logging.info("Writing train src to: %s" % src_train)
-        tf.logging.info("Writing train ref to: %s" % ref_train)
+    # pass 1: count lines
+    total = min(_count_lines(src_filename), _count_lines(ref_filename))
+
+    # sample dev lines, index -> position in dev set
+    N = min(total, sample_size)
+    dev_index = {i: k for k, i in enumerate(random.sample(range(total), N))}
+    dev_lines = [None] * N
+
+    tf.logging.info("Sample size: %d, total corpus: %d" % (N, total))
+    tf.logging.info("Writing train src to: %s" % src_train)
+    tf.logging.info("Writing train ref to: %s" % ref_train)
+
+    # pass 2: write train, collect dev
+    with compressed.open_text(src_filename, 'r') as f_src, \
+        compressed.open_text(ref_filename, 'r') as f_ref, \
+        compressed.open_text(src_train, 'w') as f_train_src, \
+        compressed.open_text(ref_train, 'w') as f_train_ref:
+
+        for i, (line_src, line_ref) in enumerate(zip(f_src, f_ref)):
+            k = dev_index.get(i)
+            if k is None:
+                f_train_src.write(line_src)
+                f_train_ref.write(line_ref)
+            else:
+                dev_lines[k] = (line_src, line_ref)
 
-        for i in index_shuf[N:]:
-            f_train_src.write(lines_src[i])
-            f_train_ref.write(lines_ref[i])
+    tf.logging.info("Writing dev src to: %s" % src_dev)
+    tf.logging.info("Writing dev ref to: %s" % ref_dev)
+    with compressed.open_text(src_dev, 'w') as f_dev_src, \
+        compressed.open_text(ref_dev, 'w') as f_dev_ref:
+        for line_src, line_ref in dev_lines:
+            f_dev_src.write(line_src)
+            f_dev_ref.write(line_ref)
 
 
 def merge_blanks_and_write(src, ref, output_src, output_ref):
-    src_lines, ref_lines = _merge_blanks(src, ref, verbose=True)
-
-    tf.logging.info("writing to: %s" % output_src)
-    with io.open(output_src, 'w', encoding='utf8') as f:
-        for l in src_lines:
-            f.write(l + os.linesep)
+    """Merge blank lines, see _merge_blanks. Streams the corpus, writing to 
+    temporary files renamed when done, so output may be the same as input.
+    """
+    tf.logging.info("writing to: %s, %s" % (output_src, output_ref))
+    with compressed.open_text(output_src + ".incomplete", 'wb') as f_src, \
+        compressed.open_text(output_ref + ".incomplete", 'wb') as f_ref:
+        for s, t in _merge_blanks(src, ref):
+            f_src.write((s + os.linesep).encode('utf8'))
+            f_ref.write((t + os.linesep).encode('utf8'))
+    os.rename(output_src + ".incomplete", output_src)
+    os.rename(output_ref + ".incomplete", output_ref)
+
+def _join(a, b):
+    return "%s %s" % (a, b) if a else b
 
-    tf.logging.info("writing to: %s" % output_ref)
-    with io.open(output_ref, 'w', encoding='utf8') as f:
-        for l in ref_lines:
-            f.write(l + os.linesep)
-    
 def _merge_blanks(src, targ, verbose=False):
     """Read parallel corpus 2 lines at a time. 
     Merge both sentences if only either source or target has blank 2nd line. 
     If both have blank 2nd lines, then ignore. 
+
+    Streams both files with one line of look-ahead, in constant memory.
+    A run of continuation lines is merged into the same sentence.
     
-    Returns tuple (src_lines, targ_lines), arrays of strings sentences. 
+    Yields tuples (src_line, targ_line) of stripped unicode sentences.
     """
-    merges_done = [] # array of indices of rows merged
-    sub = None # replace sentence after merge
-    
-    with open(src, 'rb') as src_file, open(targ, 'rb') as targ_file: 
-        src_lines = src_file.readlines()
-        targ_lines = targ_file.readlines()
-        
-        print("src: %d, targ: %d" % (len(src_lines), len(targ_lines)))
-        print("=" * 30)
-        for i in range(0, len(src_lines) - 1):
-            s = src_lines[i].decode('utf-8').rstrip()
-            s_next = src_lines[i+1].decode('utf-8').rstrip()
-            
-            t = targ_lines[i].decode('utf-8').rstrip()
-            t_next = targ_lines[i+1].decode('utf-8').rstrip()
-            
-            
-            if t == '.':
-                t = '' 
+    num_lines, num_merges = 0, 0
+    current = None
+
+    with compressed.open_text(src, 'rb') as src_file, \
+        compressed.open_text(targ, 'rb') as targ_file: 
+        for s_next, t_next in zip(src_file, targ_file):
+            num_lines += 1
+            s_next = s_next.decode('utf8').strip()
+            t_next = t_next.decode('utf8').strip()
             if t_next == '.':
                 t_next = ''
-                
-            if (len(s_next) == 0) and (len(t_next) > 0):
-                targ_lines[i] = "%s %s" % (t, t_next) # assume it has punctuation
-                targ_lines[i+1] = b''
-                src_lines[i] = s if len(s) > 0 else sub
-                
-                merges_done.append(i)
-                if verbose: 
-                    print("t [%d] src: %s\n      targ: %s" % (i, src_lines[i], targ_lines[i]))
-                    print()
-                
-            elif (len(s_next) > 0) and (len(t_next) == 0):
-                src_lines[i] = "%s %s" % (s, s_next) # assume it has punctuation
-                src_lines[i+1] = b''
-                targ_lines[i] = t if len(t) > 0 else sub
-                
-                merges_done.append(i)
-                if verbose:
-                    print("s [%d] src: %s\n      targ: %s" % (i, src_lines[i], targ_lines[i]))
-                    print()
-            elif (len(s) == 0) and (len(t) == 0):
+
+            if current is not None:
+                s, t = current
+                if (len(s_next) == 0) and (len(t_next) > 0):
+                    current = (s, _join(t, t_next)) # assume it has punctuation
+                    num_merges += 1
+                    if verbose:
+                        tf.logging.info("t [%d] src: %s\n      targ: %s" % (num_lines, current[0], current[1]))
+                    continue
+                if (len(s_next) > 0) and (len(t_next) == 0):
+                    current = (_join(s, s_next), t) # assume it has punctuation
+                    num_merges += 1
+                    if verbose:
+                        tf.logging.info("s [%d] src: %s\n      targ: %s" % (num_lines, current[0], current[1]))
+                    continue
                 # both blank -- remove
-                merges_done.append(i)
-            else:
-                src_lines[i] = s if len(s) > 0 else sub
-                targ_lines[i] = t if len(t) > 0 else sub
-                
-        # handle last line
-        s_last = src_lines[-1].decode('utf-8').strip()
-        t_last = targ_lines[-1].decode('utf-8').strip()
-        if (len(s_last) == 0) and (len(t_last) == 0):
-            merges_done.append(len(src_lines) - 1)
-        else:
-            src_lines[-1] = s_last
-            targ_lines[-1] = t_last
-            
-    # remove empty sentences
-    for m in reversed(merges_done):
-        del src_lines[m]
-        del targ_lines[m]
-    
-    print("merges done: %d" % len(merges_done))
-    return (src_lines, targ_lines)
\ No newline at end of file
+                if (len(s) > 0) or (len(t) > 0):
+                    yield current
+                else:
+                    num_merges += 1
+            current = (s_next, t_next)
+
+        if current is not None and ((len(current[0]) > 0) or (len(current[1]) > 0)):
+            yield current
+        elif current is not None:
+            num_merges += 1
+
+    tf.logging.info("lines: %d, merges done: %d" % (num_lines, num_merges))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Source dataset of each line of a merged corpus.
+
+merge_artifacts concatenates datasets (news commentary, cwmt, UN, ...) into
+one file, and clean_parallel drops lines from it. A sidecar file
+<filepath>.sources.json records the datasets in order, as
+[[name, num_lines], ...], so later stages can report counts per dataset.
+"""
+import tensorflow as tf
+import json
+import bisect
+
+def _sources_path(filepath):
+    return filepath + ".sources.json"
+
+def write_sources(filepath, segments):
+    """Record segments, a list of (dataset name, num_lines), for filepath"""
+    with tf.gfile.GFile(_sources_path(filepath), mode="w") as f:
+        json.dump([[name, int(n)] for name, n in segments], f)
+
+def read_sources(filepath):
+    """Segments of filepath as a list of (dataset name, num_lines), None if unknown"""
+    path = _sources_path(filepath)
+    if not tf.gfile.Exists(path):
+        return None
+    with tf.gfile.GFile(path, mode="r") as f:
+        return [(name, n) for name, n in json.load(f)]
+
+class SourceMap(object):
+    """Maps line numbers of a merged file to dataset names.
+    Lines past the known segments, or of a file without sources, map to "unknown".
+    """
+
+    def __init__(self, segments=None):
+        self.names = []
+        self._ends = []
+        end = 0
+        for name, n in segments or []:
+            end += n
+            self.names.append(name)
+            self._ends.append(end)
+
+    @classmethod
+    def for_file(cls, filepath):
+        return cls(read_sources(filepath))
+
+    def name(self, line_num):
+        i = bisect.bisect_right(self._ends, line_num)
+        return self.names[i] if i < len(self.names) else "unknown"
+
+    def append(self, name, n=1):
+        """Add n lines of dataset name after the known segments"""
+        if self.names and self.names[-1] == name:
+            self._ends[-1] += n
+        else:
+            self.names.append(name)
+            self._ends.append((self._ends[-1] if self._ends else 0) + n)
+
+    def segments(self):
+        """List of (dataset name, num_lines), see write_sources"""
+        starts = [0] + self._ends[:-1]
+        return [(name, end - start) for name, start, end in zip(self.names, starts, self._ends)]
+
+def format_counts(counts):
+    """e.g. 'nc: too_long=12; un: too_long=340' for a dict name -> Counter"""
+    return "; ".join("%s: %s" % (name, ", ".join("%s=%d" % item for item in sorted(c.items())))
+                     for name, c in sorted(counts.items())) or "none"
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Sentence-level cache of jieba segmentation.
+
+The UN and CWMT corpora repeat many Chinese lines verbatim (headers, agenda
+items, boilerplate). SegmentCache keys each line on its md5 and keeps
+segmentations in a bounded in-memory LRU, backed by an optional sqlite store
+so later prepare_data runs, and other problems sharing tmp_dir, reuse them.
+
+Worker processes forked by segmentation pools inherit the cache, and open
+their own connection to the store on first use.
+"""
+import tensorflow as tf
+import os
+import sqlite3
+import hashlib
+
+from .encoder_cache import LRUCache
+
+# default max lines in the in-memory LRU
+SEGMENT_CACHE_SIZE = 2**18
+
+# new entries buffered before they are written to the store
+_FLUSH_SIZE = 10000
+
+# seconds to wait on a store locked by another worker
+_STORE_TIMEOUT = 600
+
+def line_key(line, version=0):
+    """md5 digest of a line, and the version of the segmentation"""
+    return hashlib.md5(("%d\0" % version).encode("utf-8") + line.encode("utf-8")).digest()
+
+class SegmentCache(object):
+    """Segmentations of lines, in an LRU and an optional sqlite store.
+
+    Args:
+        max_size: max lines in the in-memory LRU
+        path: sqlite store, None for in-memory only
+        version: segmentation version, part of the key, e.g. PREPROCESS_VERSION
+    """
+
+    def __init__(self, max_size=SEGMENT_CACHE_SIZE, path=None, version=0):
+        self.path = path
+        self.version = version
+        self.store_hits = 0
+        self._lru = LRUCache(max_size)
+        self._pending = []
+        self._db = None
+        self._pid = None
+
+    def _store(self):
+        """Connection to the store, opened once per process"""
+        if self.path is None:
+            return None
+        if self._pid != os.getpid():
+            # a connection must not be shared with a forked process
+            self._db = sqlite3.connect(self.path, timeout=_STORE_TIMEOUT)
+            self._db.execute("CREATE TABLE IF NOT EXISTS segments "
+                             "(key BLOB PRIMARY KEY, segmented TEXT)")
+            self._db.commit()
+            self._pid = os.getpid()
+        return self._db
+
+    def segment(self, line, segment_fn):
+        """Segmentation of line, calls segment_fn(line) on a miss"""
+        key = line_key(line, self.version)
+        segmented = self._lru.get(key)
+        if segmented is not None:
+            return segmented
+
+        store = self._store()
+        if store is not None:
+            row = store.execute("SELECT segmented FROM segments WHERE key = ?",
+                                (sqlite3.Binary(key),)).fetchone()
+            if row is not None:
+                self.store_hits += 1
+                self._lru.put(key, row[0])
+                return row[0]
+
+        segmented = segment_fn(line)
+        self._lru.put(key, segmented)
+        if store is not None:
+            self._pending.append((sqlite3.Binary(key), segmented))
+            if len(self._pending) >= _FLUSH_SIZE:
+                self.flush()
+        return segmented
+
+    def flush(self):
+        """Write new segmentations to the store"""
+        if not self._pending:
+            return
+        store = self._store()
+        store.executemany("INSERT OR IGNORE INTO segments VALUES (?, ?)", self._pending)
+        store.commit()
+        self._pending = []
+
+    @property
+    def hits(self):
+        return self._lru.hits
+
+    @property
+    def misses(self):
+        # LRU misses found in the store are not segmented
+        return self._lru.misses - self.store_hits
+
+    def stats(self):
+        """Counters of lines served from memory, from the store, and segmented"""
+        return {
+            "memory_hits": self._lru.hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+        }
+
+    def add_stats(self, stats):
+        """Add the counters of a worker process, see stats"""
+        self._lru.hits += stats["memory_hits"]
+        self._lru.misses += stats["store_hits"] + stats["misses"]
+        self.store_hits += stats["store_hits"]
+
+    def reset_stats(self):
+        self._lru.hits = self._lru.misses = self.store_hits = 0
+
+    def hit_rate(self):
+        total = self._lru.hits + self._lru.misses
+        return (self._lru.hits + self.store_hits) / float(total) if total else 0.0
+
+    def log_stats(self, name="segment"):
+        tf.logging.info("[segment_cache] %s: hit rate %.3f (%d memory, %d store hits, "
+                        "%d segmented), %d entries" % (name, self.hit_rate(),
+                        self._lru.hits, self.store_hits, self.misses, len(self._lru)))
+
+    def close(self):
+        if self._db is not None and self._pid == os.getpid():
+            self.flush()
+            self._db.close()
+        self._db = None
+        self._pid = None
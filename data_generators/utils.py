@@ -7,16 +7,40 @@ Adaptation of tensor2tensor/data_generators/generator_utils.py
 import tensorflow as tf
 import os
 import tarfile
+import gzip
+import shutil
 import re
-from collections import defaultdict
+import math
+import json
+import hashlib
+import multiprocessing
+import itertools
+from collections import defaultdict, deque, Counter, OrderedDict
 
 from tensor2tensor.data_generators.generator_utils import maybe_download
 from tensor2tensor.data_generators.generator_utils import gunzip_file
 from tensor2tensor.data_generators.generator_utils import text_encoder
 from tensor2tensor.data_generators import tokenizer
 
-import jieba
-jieba.initialize()
+from . import dedup as dedup_utils
+from . import vocab_builder
+from . import encoder_cache
+from . import provenance
+from . import segment_cache
+from . import compressed
+
+# jieba is imported on first segmentation, see _jieba, so importing
+# the problems (e.g. as t2t_usr_dir) does not load its dictionary
+_JIEBA = None
+
+def _jieba():
+    """jieba module, with its prefix dictionary built on first call"""
+    global _JIEBA
+    if _JIEBA is None:
+        import jieba
+        jieba.initialize()
+        _JIEBA = jieba
+    return _JIEBA
 
 # from tensor2tensor
 def _preprocess_sgm(line, is_sgm):
@@ -39,13 +63,45 @@ def _preprocess_sgm(line, is_sgm):
 def _get_dataset_filename(dataset):
     return dataset[0][1][0]
 
+# bump when _preprocess output changes, invalidates cached stage artifacts
+PREPROCESS_VERSION = 1
+
+# segmentation cache of _preprocess, see use_segment_cache
+_SEGMENT_CACHE = None
+
+def use_segment_cache(path=None, max_size=segment_cache.SEGMENT_CACHE_SIZE):
+    """Cache jieba segmentation of lines in _preprocess, see segment_cache.py.
+    Forked segmentation workers inherit the cache.
+
+    Args:
+        path: sqlite store of segmentations, shared across runs. 
+            None keeps them in memory only.
+        max_size: max lines in the in-memory LRU
+
+    Returns:
+        the SegmentCache, for its hit rate stats
+    """
+    global _SEGMENT_CACHE
+    if _SEGMENT_CACHE is not None:
+        if _SEGMENT_CACHE.path == path:
+            return _SEGMENT_CACHE
+        _SEGMENT_CACHE.close()
+    _SEGMENT_CACHE = segment_cache.SegmentCache(max_size, path, PREPROCESS_VERSION)
+    return _SEGMENT_CACHE
+
+def _segment(line):
+    return " ".join(_jieba().cut(line))
+
 def _preprocess(line, is_zh=False):
     # remove xml tags
     line = re.sub(r'<.+?>', '', line.strip())
         
     # tokenize with jieba
     if is_zh:
-        line = " ".join(jieba.cut(line))
+        if _SEGMENT_CACHE is None:
+            line = _segment(line)
+        else:
+            line = _SEGMENT_CACHE.segment(line, _segment)
 
     return line
 
@@ -70,6 +126,139 @@ def _clean_parallel(src_path, ref_path):
     # TODO
     pass
 
+# byte size of each shard handed to a segmentation worker
+_SEGMENT_CHUNK_SIZE = 2**24  # 16MB
+
+def _line_aligned_ranges(filepath, chunk_size=_SEGMENT_CHUNK_SIZE):
+    """Split file into byte ranges of roughly chunk_size bytes.
+    Each range [start, end) ends on a line boundary, so no line is split 
+    between two shards. 
+    """
+    size = os.path.getsize(filepath)
+    ranges = []
+    with open(filepath, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def _line_aligned_chunks(fileobj, chunk_size=_SEGMENT_CHUNK_SIZE):
+    """Read binary file object in blocks of roughly chunk_size bytes, 
+    each block ending on a line boundary. Works on non-seekable streams.
+    """
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            break
+        if not data.endswith(b"\n"):
+            data += fileobj.readline()
+        yield data
+
+def _init_segment_worker(is_zh):
+    """Build jieba prefix dictionary once per worker process,
+    a no-op if inherited from the parent by fork
+    """
+    if is_zh:
+        _jieba()
+    if _SEGMENT_CACHE is not None:
+        # counters inherited from the parent are already counted there
+        _SEGMENT_CACHE.reset_stats()
+
+def _segment_chunk(args):
+    """Preprocess a block of utf-8 encoded lines.
+    Returns preprocessed lines as a single newline-terminated string, 
+    and the segmentation cache stats of the block, or None.
+    """
+    data, is_zh = args
+    data = data.decode("utf-8")
+    # split on newline only, str.splitlines also breaks on unicode separators
+    lines = data.split("\n")
+    if data.endswith("\n"):
+        lines.pop()
+    shard = "".join(_preprocess(line, is_zh) + "\n" for line in lines)
+    if _SEGMENT_CACHE is None or not is_zh:
+        return shard, None
+    _SEGMENT_CACHE.flush()
+    stats = _SEGMENT_CACHE.stats()
+    _SEGMENT_CACHE.reset_stats()
+    return shard, stats
+
+def _segment_range(args):
+    """Preprocess lines in byte range [start, end) of filepath."""
+    filepath, start, end, is_zh = args
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return _segment_chunk((data, is_zh))
+
+def ordered_imap(pool, func, tasks, max_pending):
+    """Like pool.imap, but holds at most max_pending tasks in flight, 
+    so a lazy tasks iterator is not read ahead into memory.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _segment_pool(func, tasks, out_file, num_workers, is_zh):
+    if is_zh:
+        # build the dictionary once here, forked workers inherit it
+        _jieba()
+    if _SEGMENT_CACHE is not None:
+        # or workers would write the parent's new entries again
+        _SEGMENT_CACHE.flush()
+    pool = multiprocessing.Pool(num_workers, initializer=_init_segment_worker,
+                                initargs=(is_zh,))
+    try:
+        # results are written in task order
+        for shard, stats in ordered_imap(pool, func, tasks, 2 * num_workers):
+            out_file.write(shard)
+            if stats is not None:
+                _SEGMENT_CACHE.add_stats(stats)
+    finally:
+        pool.close()
+        pool.join()
+
+def segment_parallel(filepath, out_file, is_zh, num_workers, 
+                     chunk_size=_SEGMENT_CHUNK_SIZE):
+    """Preprocess filepath in a pool of num_workers processes.
+    File is sharded into line-aligned byte ranges of chunk_size bytes, 
+    and shards are written to out_file in original order, keeping 
+    line alignment with the other side of the parallel corpus. 
+
+    Args:
+        filepath: path to local text file to preprocess
+        out_file: writable file object, preprocessed lines are appended
+        is_zh: tokenize lines with jieba
+        num_workers: number of worker processes
+        chunk_size: approximate byte size of each shard
+    """
+    ranges = _line_aligned_ranges(filepath, chunk_size)
+    tf.logging.info("[segment_parallel] %s: %d shards, %d workers" % 
+                    (filepath, len(ranges), num_workers))
+    tasks = [(filepath, start, end, is_zh) for start, end in ranges]
+    _segment_pool(_segment_range, tasks, out_file, num_workers, is_zh)
+
+def segment_stream(source_file, out_file, is_zh, num_workers=1, 
+                   chunk_size=_SEGMENT_CHUNK_SIZE):
+    """Preprocess lines of a binary file object, e.g. a tar member stream, 
+    and write to out_file. Uses a pool of num_workers processes if > 1.
+    """
+    if num_workers > 1:
+        tasks = ((data, is_zh) for data in _line_aligned_chunks(source_file, chunk_size))
+        _segment_pool(_segment_chunk, tasks, out_file, num_workers, is_zh)
+    else:
+        for line in source_file:
+            line = _preprocess(line.decode("utf-8").strip(), is_zh)
+            out_file.write(line + "\n")
+
 def do_files_exist(filepaths):
     return not(False in [tf.gfile.Exists(f) for f in filepaths])
 
@@ -81,10 +270,90 @@ def get_lang(filename):
     else:
         return filename.split('.')[-1]
 
-def prepare_data(data_dir, tmp_dir, sources, out_filename="train.tok", use_jieba=True):
+def _open_member(corpus_tar, member):
+    """Open tar member as binary stream, decompressing .gz members"""
+    fileobj = corpus_tar.extractfile(member)
+    if member.name.endswith(".gz"):
+        fileobj = gzip.GzipFile(fileobj=fileobj)
+    return fileobj
+
+def prepare_archive_stream(tmp_dir, compressed_file, targets, use_jieba=True,
+                           num_workers=1, chunk_size=_SEGMENT_CHUNK_SIZE):
+    """Preprocess files read straight from the tar stream, in a single
+    pass over the archive. Nothing is extracted to disk.
+
+    Members are appended to their target file in the order of targets, 
+    keeping line alignment between languages. A member found ahead of its 
+    turn in the archive is preprocessed to a staging file in tmp_dir and 
+    appended once the members before it are written.
+
+    Args:
+        tmp_dir: directory for staging files
+        compressed_file: path to tar archive
+        targets: list of (lang_file, pp_filepath) tuples, e.g. 
+            ("en-zh/UNv1.0.en-zh.en", "/data/train.tok.en")
+    """
+    # member name -> target file, and per target file the member order
+    members = {}
+    queues = defaultdict(deque)
+    for lang_file, pp_filepath in targets:
+        lang = get_lang(lang_file)
+        members[os.path.normpath(lang_file)] = (pp_filepath, lang)
+        queues[pp_filepath].append(os.path.normpath(lang_file))
+    staged = {}
+
+    def flush_staged(pp_filepath):
+        queue = queues[pp_filepath]
+        while queue and queue[0] in staged:
+            staged_path = staged.pop(queue.popleft())
+            with compressed.open_text(staged_path, mode="rb") as staged_file:
+                with compressed.open_text(pp_filepath, mode="ab") as out_file:
+                    shutil.copyfileobj(staged_file, out_file)
+            tf.gfile.Remove(staged_path)
+
+    with tarfile.open(compressed_file, "r|*") as corpus_tar:
+        for member in corpus_tar:
+            name = os.path.normpath(member.name)
+            if name not in members or not member.isfile():
+                continue
+            pp_filepath, lang = members[name]
+            is_zh = lang == "zh" and use_jieba
+
+            in_order = queues[pp_filepath][0] == name
+            if in_order:
+                out_path, mode = pp_filepath, "a"
+                tf.logging.info("Streaming file: %s, preprocessing to target file: %s" % 
+                                (name, pp_filepath))
+            else:
+                out_path, mode = os.path.join(tmp_dir, name.replace(os.sep, "_") + ".pp"), "w"
+                tf.logging.info("Streaming file: %s, out of order, staging to: %s" % 
+                                (name, out_path))
+
+            source_file = _open_member(corpus_tar, member)
+            with compressed.open_text(out_path, mode=mode) as out_file:
+                segment_stream(source_file, out_file, is_zh, num_workers, chunk_size)
+
+            if in_order:
+                queues[pp_filepath].popleft()
+            else:
+                staged[name] = out_path
+            flush_staged(pp_filepath)
+
+    missing = [name for queue in queues.values() for name in queue]
+    if missing:
+        raise ValueError("Files not found in archive %s: %s" % (compressed_file, missing))
+
+def prepare_data(data_dir, tmp_dir, sources, out_filename="train.tok", use_jieba=True,
+                 num_workers=1, chunk_size=_SEGMENT_CHUNK_SIZE, stream=True):
     """Preprocess dataset. Download, unarchive and preprocess. 
     Skips processing if file exists. 
     Writes to e.g. /data/t2t_datagen/train.tok.en
+
+    If num_workers > 1, lines are preprocessed in a pool of worker processes,
+    on shards of chunk_size bytes. See segment_parallel. 
+
+    If stream is True, files are read straight from the archive without 
+    extracting to tmp_dir. See prepare_archive_stream. 
     """
 
     for source in sources:
@@ -92,6 +361,13 @@ def prepare_data(data_dir, tmp_dir, sources, out_filename="train.tok", use_jieba
         filename = os.path.basename(url)
         compressed_file = maybe_download(tmp_dir, filename, url)
 
+        if stream:
+            targets = [(lang_file, os.path.join(data_dir, "%s.%s" % (out_filename, get_lang(lang_file))))
+                       for lang_file in source[1]]
+            prepare_archive_stream(tmp_dir, compressed_file, targets, use_jieba,
+                num_workers, chunk_size)
+            continue
+
         for lang_file in source[1]:
             # pre-processed dataset path, e.g. train.tok.en
             lang = get_lang(lang_file)
@@ -118,21 +394,299 @@ def prepare_data(data_dir, tmp_dir, sources, out_filename="train.tok", use_jieba
                 filepath = new_filepath
 
             # read and clean each line, and write to target
-            with tf.gfile.GFile(filepath, mode="r") as source_file:
-                with tf.gfile.GFile(pp_filepath, mode="a") as out_file:
-                    is_zh = lang == "zh"
-                    is_zh = is_zh and use_jieba
-                    for line in source_file:
-                        line = _preprocess(line.strip(), is_zh)
-                        out_file.write(line + "\n")
+            is_zh = lang == "zh" and use_jieba
+            with compressed.open_text(pp_filepath, mode="a") as out_file:
+                if num_workers > 1:
+                    # segment_parallel reads filepath itself
+                    segment_parallel(filepath, out_file, is_zh, num_workers, chunk_size)
+                else:
+                    with tf.gfile.GFile(filepath, mode="r") as source_file:
+                        for line in source_file:
+                            line = _preprocess(line.strip(), is_zh)
+                            out_file.write(line + "\n")
+
+
+#
+# raw parallel data, as tensor2tensor translate.compile_data
+#
 
+def group_by_archive(datasets):
+    """Files of dataset entries grouped by archive url, in order of first use.
+
+    Args:
+        datasets: list of [url, [lang1_file, lang2_file]], e.g. 
+            base._FULL_TRAIN_DATASETS, where an archive may appear many times
+
+    Returns:
+        list of (url, list of files)
+    """
+    groups = OrderedDict()
+    for url, files in datasets:
+        members = groups.setdefault(url, [])
+        members.extend(f for f in files if f not in members)
+    return list(groups.items())
+
+def _member_path(tmp_dir, member):
+    """Extracted path of an archive member, .gz members are stored decompressed"""
+    return os.path.join(tmp_dir, member[:-3] if member.endswith(".gz") else member)
+
+def extract_members(tmp_dir, url, members):
+    """Download the archive at url and extract members to tmp_dir, in a single 
+    streaming pass. Members already extracted are skipped, and the archive is
+    not read at all if none are missing.
+
+    Returns:
+        dict of member -> extracted path, see _member_path
+    """
+    paths = {member: _member_path(tmp_dir, member) for member in members}
+    missing = {os.path.normpath(m): p for m, p in paths.items() if not tf.gfile.Exists(p)}
+    if not missing:
+        return paths
+
+    filename = os.path.basename(url)
+    compressed_file = maybe_download(tmp_dir, filename, url)
+    tf.logging.info("[extract] %s: %d members" % (compressed_file, len(missing)))
+    with tarfile.open(compressed_file, "r|*") as corpus_tar:
+        for member in corpus_tar:
+            name = os.path.normpath(member.name)
+            if name not in missing or not member.isfile():
+                continue
+            path = missing.pop(name)
+            tf.gfile.MakeDirs(os.path.dirname(path))
+            source_file = _open_member(corpus_tar, member)
+            with tf.gfile.GFile(path + ".incomplete", mode="wb") as out_file:
+                shutil.copyfileobj(source_file, out_file)
+            tf.gfile.Rename(path + ".incomplete", path, overwrite=True)
+            if not missing:
+                break
+    if missing:
+        raise ValueError("Files not found in archive %s: %s" % (compressed_file, sorted(missing)))
+    return paths
+
+# bump when compile_data_cached output changes
+_COMPILE_VERSION = 1
+
+def _compile_key(datasets):
+    key = json.dumps([[url, list(files)] for url, files in datasets] + [_COMPILE_VERSION])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def compile_data_cached(tmp_dir, datasets, filename):
+    """Concatenate datasets to tmp_dir/filename.lang1, .lang2, same output as
+    tensor2tensor translate.compile_data for [url, [lang1_file, lang2_file]] entries.
+
+    Each archive is read once for all its entries, see extract_members.
+    The output is kept, with a filename.json manifest of the dataset list, 
+    and reused by later calls with the same datasets.
+
+    Returns:
+        path of the output, without .lang1 / .lang2
+    """
+    filename = os.path.join(tmp_dir, filename)
+    outputs = [filename + ".lang1", filename + ".lang2"]
+    manifest = filename + ".json"
+    key = _compile_key(datasets)
+    if do_files_exist(outputs + [manifest]):
+        with tf.gfile.GFile(manifest, mode="r") as f:
+            info = json.load(f)
+        if info["key"] == key and info["bytes"] == [tf.gfile.Stat(p).length for p in outputs]:
+            tf.logging.info("[compile] found %s" % filename)
+            return filename
+        tf.gfile.Remove(manifest)
+
+    paths = extract_datasets(tmp_dir, datasets)
+    tf.logging.info("[compile] writing %d datasets to %s" % (len(datasets), filename))
+    with tf.gfile.GFile(outputs[0] + ".incomplete", mode="w") as lang1_resfile:
+        with tf.gfile.GFile(outputs[1] + ".incomplete", mode="w") as lang2_resfile:
+            for url, (lang1_filename, lang2_filename) in datasets:
+                is_sgm = lang1_filename.endswith("sgm") and lang2_filename.endswith("sgm")
+                with tf.gfile.GFile(paths[(url, lang1_filename)], mode="r") as lang1_file:
+                    with tf.gfile.GFile(paths[(url, lang2_filename)], mode="r") as lang2_file:
+                        line1, line2 = lang1_file.readline(), lang2_file.readline()
+                        while line1 or line2:
+                            line1res = _preprocess_sgm(line1, is_sgm)
+                            line2res = _preprocess_sgm(line2, is_sgm)
+                            if line1res or line2res:
+                                lang1_resfile.write(line1res.strip() + "\n")
+                                lang2_resfile.write(line2res.strip() + "\n")
+                            line1, line2 = lang1_file.readline(), lang2_file.readline()
+    for path in outputs:
+        tf.gfile.Rename(path + ".incomplete", path, overwrite=True)
+    with tf.gfile.GFile(manifest, mode="w") as f:
+        json.dump({"key": key, "bytes": [tf.gfile.Stat(p).length for p in outputs]}, f)
+    return filename
+
+def extract_datasets(tmp_dir, datasets):
+    """Extract the files of datasets, reading each archive once.
+
+    Returns:
+        dict of (url, file) -> extracted path
+    """
+    paths = {}
+    for url, members in group_by_archive(datasets):
+        for member, path in extract_members(tmp_dir, url, members).items():
+            paths[(url, member)] = path
+    return paths
+
+def sample_datasets(tmp_dir, datasets, index, file_byte_budget=1e6):
+    """Vocab sample of language index (0 or 1) of datasets, the lines
+    tensor2tensor generator_utils.get_or_generate_vocab reads, but extracting
+    each archive once instead of once per missing file.
+    """
+    paths = extract_datasets(tmp_dir, datasets)
+    for url, files in datasets:
+        tf.logging.info("[vocab] reading file: %s" % files[index])
+        for line in sample_lines(paths[(url, files[index])], file_byte_budget):
+            yield line
+
+def sample_lines(filepath, file_byte_budget=1e6):
+    """Evenly spaced lines of filepath, about file_byte_budget bytes in total.
+    Same sampling as tensor2tensor generator_utils.get_or_generate_vocab 
+    applies to each dataset file.
+    """
+    with tf.gfile.GFile(filepath, mode="r") as source_file:
+        counter = 0
+        countermax = int(tf.gfile.Stat(filepath).length / file_byte_budget / 2)
+        for line in source_file:
+            if counter < countermax:
+                counter += 1
+            else:
+                if file_byte_budget <= 0:
+                    break
+                line = line.strip()
+                file_byte_budget -= len(line)
+                counter = 0
+                yield line
+
+# byte size of each contiguous window read by the vocab sampler
+_SAMPLE_WINDOW_SIZE = 2**20  # 1MB
+
+def _sample_windows(filepath, file_byte_budget, window_size=_SAMPLE_WINDOW_SIZE):
+    """Evenly spaced (offset, nbytes) windows of filepath, 
+    adding up to file_byte_budget bytes, or the whole file if smaller.
+    """
+    if compressed.is_compressed(filepath):
+        return _sample_blocks(filepath, file_byte_budget)
+    size = tf.gfile.Stat(filepath).length
+    budget = min(int(file_byte_budget), size)
+    if budget <= 0:
+        return []
+    num_windows = int(math.ceil(budget / float(window_size)))
+    # if budget covers the whole file, windows are contiguous
+    return [(i * size // num_windows, 
+             (i + 1) * budget // num_windows - i * budget // num_windows)
+            for i in range(num_windows)]
+
+def _sample_blocks(filepath, file_byte_budget):
+    """Evenly spaced blocks of a block-compressed file, as (offset, nbytes) 
+    byte ranges, adding up to file_byte_budget uncompressed bytes.
+    """
+    blocks = compressed.block_index(filepath)
+    total = sum(usize for _, _, usize in blocks)
+    if not total or file_byte_budget <= 0:
+        return []
+    num_blocks = min(len(blocks), int(math.ceil(len(blocks) * file_byte_budget / float(total))))
+    return [blocks[i * len(blocks) // num_blocks][:2] for i in range(num_blocks)]
+
+def _count_window_tokens(args):
+    """Count tokens of lines starting in byte window [offset, offset + nbytes),
+    or of the blocks starting in it for a block-compressed file.
+    """
+    filepath, offset, nbytes = args
+    token_counts = Counter()
+    if compressed.is_compressed(filepath):
+        with compressed.BlockReader(filepath, "rb", offset, offset + nbytes) as f:
+            for line in f:
+                token_counts.update(tokenizer.encode(text_encoder.native_to_unicode(line.strip())))
+        return token_counts
+    with tf.gfile.GFile(filepath, mode="rb") as f:
+        # skip to the first line starting at or after offset
+        if offset > 0:
+            f.seek(offset - 1)
+            f.readline()
+        end = offset + nbytes
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            token_counts.update(tokenizer.encode(text_encoder.native_to_unicode(line.strip())))
+    return token_counts
+
+def sample_token_counts(filepath, file_byte_budget, num_workers=1):
+    """Count tokens in a sample of file_byte_budget bytes of filepath.
+    Reads only the sampled bytes: evenly spaced windows of the file, counted 
+    in a pool of num_workers processes if > 1 and merged. 
+    """
+    windows = _sample_windows(filepath, file_byte_budget)
+    tf.logging.info("[sample_token_counts] %s: %d windows, %d workers" % 
+                    (filepath, len(windows), num_workers))
+    tasks = [(filepath, offset, nbytes) for offset, nbytes in windows]
+    token_counts = Counter()
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            for counts in pool.imap_unordered(_count_window_tokens, tasks):
+                token_counts.update(counts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            token_counts.update(_count_window_tokens(task))
+    return token_counts
+
+# bump when token counting changes, invalidates cached token counts
+_TOKEN_COUNTS_VERSION = 1
+
+def file_fingerprint(filepath, sample_size=2**20):
+    """Cheap fingerprint of a file: size, mtime and md5 of its first and last 
+    sample_size bytes.
+    """
+    stat = tf.gfile.Stat(filepath)
+    md5 = hashlib.md5()
+    with tf.gfile.GFile(filepath, mode="rb") as f:
+        md5.update(f.read(sample_size))
+        if stat.length > sample_size:
+            f.seek(max(sample_size, stat.length - sample_size))
+            md5.update(f.read(sample_size))
+    return "%d-%d-%s" % (stat.length, stat.mtime_nsec, md5.hexdigest())
+
+def _token_counts_path(cache_dir, filepath, file_byte_budget):
+    key = json.dumps([file_fingerprint(filepath), int(file_byte_budget), 
+                      _SAMPLE_WINDOW_SIZE, _TOKEN_COUNTS_VERSION])
+    key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "token_counts.%s.%s.json.gz" % 
+                        (os.path.basename(filepath), key))
+
+def get_or_sample_token_counts(filepath, file_byte_budget, num_workers=1, cache_dir=None):
+    """sample_token_counts, cached as gzipped json in cache_dir.
+    Cache is keyed on the dataset file fingerprint and byte budget, so e.g. a 
+    sweep over vocab sizes counts tokens only once. 
+    """
+    if cache_dir is None:
+        return sample_token_counts(filepath, file_byte_budget, num_workers)
+
+    counts_path = _token_counts_path(cache_dir, filepath, file_byte_budget)
+    if tf.gfile.Exists(counts_path):
+        tf.logging.info("Found token counts: %s" % counts_path)
+        with tf.gfile.GFile(counts_path, mode="rb") as f:
+            with gzip.GzipFile(fileobj=f, mode="rb") as gz:
+                return Counter(json.loads(gz.read().decode("utf-8")))
+
+    token_counts = sample_token_counts(filepath, file_byte_budget, num_workers)
+    tf.logging.info("Storing token counts: %s" % counts_path)
+    with tf.gfile.GFile(counts_path + ".incomplete", mode="wb") as f:
+        with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+            gz.write(json.dumps(token_counts, ensure_ascii=False).encode("utf-8"))
+    tf.gfile.Rename(counts_path + ".incomplete", counts_path, overwrite=True)
+    return token_counts
 
 def get_or_generate_vocab(data_dir,
                           vocab_filename,
                           vocab_size,
                           dataset_filename,
                           _file_byte_budget=5e9,
-                          num_iterations=4):
+                          num_iterations=4,
+                          num_workers=1):
     """Generate a vocabulary from dataset_filename.
 
     *
@@ -146,30 +700,37 @@ def get_or_generate_vocab(data_dir,
         vocab_filename: relative filename where vocab file is stored
         vocab_size: target size of the vocabulary constructed by SubwordTextEncoder
         dataset_filename: filename where dataset file is stored
+        num_workers: number of processes counting tokens and building vocab candidates,
+            see sample_token_counts and vocab_builder
 
+    Token counts are cached in data_dir, see get_or_sample_token_counts.
     """
-    def generate():
-        tf.logging.info("Generating vocab from: %s" % dataset_filename)
-        filepath = os.path.join(data_dir, dataset_filename)
-        # Use Tokenizer to count the word occurrences.
-        with tf.gfile.GFile(filepath, mode="r") as source_file:
-            file_byte_budget = _file_byte_budget
-            counter = 0
-            countermax = int(source_file.size() / file_byte_budget / 2)
-            for line in source_file:
-                if counter < countermax:
-                    counter += 1
-                else:
-                    if file_byte_budget <= 0:
-                        break
-                    line = line.strip()
-                    file_byte_budget -= len(line)
-                    counter = 0
-                    yield line
+    vocab_filepath = os.path.join(data_dir, vocab_filename)
+    if tf.gfile.Exists(vocab_filepath):
+        tf.logging.info("Found vocab file: %s", vocab_filepath)
+        return text_encoder.SubwordTextEncoder(vocab_filepath)
+
+    tf.logging.info("Generating vocab from: %s" % dataset_filename)
+    filepath = os.path.join(data_dir, dataset_filename)
+    token_counts = get_or_sample_token_counts(filepath, _file_byte_budget, num_workers, 
+                                              cache_dir=data_dir)
+    return _build_vocab(vocab_filepath, vocab_size, token_counts, num_iterations, num_workers)
 
+def _build_vocab(vocab_filepath, vocab_size, token_counts, num_iterations, num_workers=1):
+    """Build SubwordTextEncoder from token_counts, store to vocab_filepath if not None.
+    min_count candidates are searched in parallel if num_workers > 1, see vocab_builder.
+    """
+    tf.logging.info("Generating vocab file: %s", vocab_filepath)
+    if num_workers > 1:
+        vocab = vocab_builder.build_to_target_size(
+            vocab_size, token_counts, 50, 1e3, int(num_iterations), num_workers)
+    else:
+        vocab = text_encoder.SubwordTextEncoder.build_to_target_size(
+            vocab_size, token_counts, 50, 1e3, int(num_iterations))
 
-    return get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
-                                     generate(), num_iterations)
+    if vocab_filepath is not None:
+        vocab.store_to_file(vocab_filepath)
+    return vocab
 
 def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
                                 generator, num_iterations=1e3):
@@ -198,18 +759,12 @@ def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
         vocab = text_encoder.SubwordTextEncoder(vocab_filepath)
         return vocab
 
-    tf.logging.info("Generating vocab file: %s", vocab_filepath)
     token_counts = defaultdict(int)
     for item in generator:
         for tok in tokenizer.encode(text_encoder.native_to_unicode(item)):
             token_counts[tok] += 1
 
-    vocab = text_encoder.SubwordTextEncoder.build_to_target_size(
-        vocab_size, token_counts, 50, 1e3, int(num_iterations))
-
-    if vocab_filepath is not None:
-        vocab.store_to_file(vocab_filepath)
-    return vocab
+    return _build_vocab(vocab_filepath, vocab_size, token_counts, num_iterations)
 
 def bi_vocabs_token_generator(source_path,
                               target_path,
@@ -226,6 +781,7 @@ def bi_vocabs_token_generator(source_path,
     * 
       This generator differs from tensor2tensor.translate.bi_vocabs_token_generator
       It adds additional logging and saves from tokenizer exceptions 
+      Vocabs are wrapped in encoder_cache.CachedEncoder to memoize encoding
     *
 
     Args:
@@ -240,8 +796,10 @@ def bi_vocabs_token_generator(source_path,
     the lines are integer lists converted from tokens in the file lines.
     """
     eos_list = [] if eos is None else [eos]
-    with tf.gfile.GFile(source_path, mode="r") as source_file:
-        with tf.gfile.GFile(target_path, mode="r") as target_file:
+    source_token_vocab = encoder_cache.cached(source_token_vocab)
+    target_token_vocab = encoder_cache.cached(target_token_vocab)
+    with compressed.open_text(source_path, mode="r") as source_file:
+        with compressed.open_text(target_path, mode="r") as target_file:
             source, target = source_file.readline(), target_file.readline()
             line_num = 0
             while source and target:                
@@ -257,64 +815,157 @@ def bi_vocabs_token_generator(source_path,
                         " " * 10, target))
                     source, target = source_file.readline(), target_file.readline()
                     line_num += 1
+    source_token_vocab.log_stats("source")
+    target_token_vocab.log_stats("target")
 
 #
 # experimental preprocessing
 #
 
-def clean_parallel(input_filenames, output_filenames, max_ratio=9.0, min_ratio=0.1111, min_src_len=5):
+# number of sentence pairs per clean_parallel shard
+_CLEAN_CHUNK_LINES = 100000
+
+def read_pair_chunks(f_src, f_ref, chunk_lines=_CLEAN_CHUNK_LINES):
+    """Read parallel files in lockstep, yields (first_line_num, src_lines, ref_lines)"""
+    line_num = 0
+    while True:
+        src_lines = list(itertools.islice(f_src, chunk_lines))
+        ref_lines = list(itertools.islice(f_ref, chunk_lines))
+        n = min(len(src_lines), len(ref_lines))
+        if n == 0:
+            break
+        yield line_num, src_lines[:n], ref_lines[:n]
+        line_num += n
+        if n < chunk_lines:
+            break
+
+def filter_reason(_src, _ref, max_ratio, min_ratio, min_src_len):
+    """Returns reason to reject a sentence pair, or None to keep it.
+    Target is already segmented with spaces by prepare_data, so words are 
+    counted with split rather than re-running jieba.
+    """
+    src_count = len(_src.split())
+    ref_count = len(_ref.split())
+
+    # skip blank lines
+    if (src_count == 0) or (ref_count == 0):
+        return "blank"
+
+    # skip short src sentences
+    if src_count < min_src_len:
+        return "short"
+
+    # skip misaligned translated
+    ratio = src_count / float(ref_count)
+    if (ratio > max_ratio) or (ratio < min_ratio):
+        return "ratio"
+    return None
+
+def _filter_chunk(args):
+    """Apply length filters to a chunk of sentence pairs.
+    Returns (kept, rejected, counts): kept as (line_num, src, ref, dedup key), 
+    rejected as (line_num, reason, src, ref) if keep_rejects, and a Counter 
+    of rejection reasons.
+    """
+    first_line, src_lines, ref_lines, params, dedup, keep_rejects = args
+    kept, rejected, counts = [], [], Counter()
+    for i, (_src, _ref) in enumerate(zip(src_lines, ref_lines)):
+        reason = filter_reason(_src, _ref, *params)
+        if reason is None:
+            kept.append((first_line + i, _src, _ref, dedup_utils.pair_key(_src, _ref, dedup)))
+            continue
+        counts[reason] += 1
+        if keep_rejects:
+            rejected.append((first_line + i, reason, _src, _ref))
+    return kept, rejected, counts
+
+def _write_reject(f_rejects, line_num, reason, _src, _ref):
+    f_rejects.write("%d\t%s\t%s\t%s\n" % (line_num, reason, _src.strip(), _ref.strip()))
+
+def clean_parallel(input_filenames, output_filenames, max_ratio=9.0, min_ratio=0.1111, min_src_len=5,
+                   dedup="exact", num_workers=1, rejects_filename=None, 
+                   chunk_lines=_CLEAN_CHUNK_LINES):
     """
     Removes sentences with < 5 Source words
     Removes sentences with > 9.0 ratio of Source/Target words (under translated)
     Removes sentences with < 0.11 ratio of Source/Target words (over translated)
     Removes duplicate sentences
+
+    Length filters run on shards of chunk_lines sentence pairs, in a pool of 
+    num_workers processes if > 1. Dedup runs in order in the main process, 
+    so output is the same for any number of workers.
     
     Args:
         input_filenames: Array or tuple of strings e.g. [source, target] to be read.
         output_filenames: Array or tuple of strings e.g. [source, target] to write 
             cleaned dataset
+        dedup: "exact" keeps every sentence pair in memory, "hash64" / "hash128"
+            keep only fixed-width fingerprints, see dedup.py for collision odds.
+        num_workers: number of filter processes
+        rejects_filename: if set, rejected lines are written to this file as
+            tab-separated line number, reason, source, target.
+
+    If the source file has recorded source datasets, see provenance.py, the
+    kept lines per dataset are recorded for the output files.
+
+    Returns:
+        Counter of rejection reasons: blank, short, ratio, duplicate.
     """
     # unpack
     src, ref = input_filenames
     src_out, ref_out = output_filenames
 
     # Set of sentences
-    sents = set()
-
-    with tf.gfile.GFile(src, mode="r") as f_src, tf.gfile.GFile(ref, mode="r") as f_ref:
-        with tf.gfile.GFile(src_out, mode="w") as f_src_out, tf.gfile.GFile(ref_out, mode="w") as f_ref_out:
-            for line_num, (_src, _ref) in enumerate(zip(f_src, f_ref)):
-
-                src_count = len(_src.split())
-                # TODO (jerry): remove whitespace ' '
-                ref_count = len(jieba.lcut(_ref))
-
-                # skip blank lines?
-                if (src_count == 0) or (ref_count ==0):
-                    tf.logging.info("[clean %d] skip blank" % line_num)
-                    continue
-
-                ratio = src_count / float(ref_count)
-
-                # skip short src sentences
-                if src_count < min_src_len:
-                    tf.logging.info("[clean %d] short src sentence: %s" % (line_num, _src))
-                    continue
-                    
-                # skip misaligned translated
-                if (ratio > max_ratio) or (ratio < min_ratio):
-                    tf.logging.info("[clean %d] misaligned, src / ref: %d / %d, ratio=%.2f" % (line_num, src_count, ref_count, ratio))
-                    continue
-
-                # filter duplicates
-                example = (_src, _ref)
-                if example in sents:
-                    tf.logging.info("[clean %d] remove duplicate" % line_num)
-                    continue
-                
-                # sentence is ok, write to file. 
-                sents.add(example)
-                f_src_out.write(_src)
-                f_ref_out.write(_ref)
-    
-    tf.logging.info("[clean]  done, total: %d" % len(sents))
\ No newline at end of file
+    sents = dedup_utils.make_dedup_set(dedup)
+    counts = Counter()
+    params = (max_ratio, min_ratio, min_src_len)
+    keep_rejects = rejects_filename is not None
+    sources = provenance.SourceMap.for_file(src)
+    kept_per_source = Counter()
+
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    f_rejects = tf.gfile.GFile(rejects_filename, mode="w") if keep_rejects else None
+    try:
+        with compressed.open_text(src, mode="r") as f_src, compressed.open_text(ref, mode="r") as f_ref:
+            with compressed.open_text(src_out, mode="w") as f_src_out, \
+                    compressed.open_text(ref_out, mode="w") as f_ref_out:
+                tasks = ((first_line, src_lines, ref_lines, params, dedup, keep_rejects)
+                         for first_line, src_lines, ref_lines in read_pair_chunks(f_src, f_ref, chunk_lines))
+                if pool is None:
+                    results = map(_filter_chunk, tasks)
+                else:
+                    results = ordered_imap(pool, _filter_chunk, tasks, 2 * num_workers)
+
+                for kept, rejected, chunk_counts in results:
+                    counts.update(chunk_counts)
+                    for line_num, reason, _src, _ref in rejected:
+                        _write_reject(f_rejects, line_num, reason, _src, _ref)
+
+                    for line_num, _src, _ref, key in kept:
+                        # filter duplicates
+                        if not sents.add_key(key):
+                            counts["duplicate"] += 1
+                            if keep_rejects:
+                                _write_reject(f_rejects, line_num, "duplicate", _src, _ref)
+                            continue
+                        # sentence is ok, write to file. 
+                        kept_per_source[sources.name(line_num)] += 1
+                        f_src_out.write(_src)
+                        f_ref_out.write(_ref)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if f_rejects is not None:
+            f_rejects.close()
+
+    if sources.names:
+        for filename in output_filenames:
+            provenance.write_sources(filename, [(name, kept_per_source[name])
+                                                for name in sources.names])
+    tf.logging.info("[clean]  done, total: %d, rejected: %s" % (len(sents), 
+        ", ".join("%s=%d" % item for item in sorted(counts.items()))))
+    peak_mb = dedup_utils.peak_memory_mb()
+    tf.logging.info("[clean]  dedup: %s, %.1f MB, peak memory: %s MB" % (dedup, 
+        sents.nbytes / 2.0**20, "%.1f" % peak_mb if peak_mb is not None else "n/a"))
+    return counts
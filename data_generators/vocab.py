@@ -23,6 +23,9 @@ parser.add_argument('-i', '--dataset_filename',
 parser.add_argument('-b', '--file_byte_budget',
     required=False, type=float, default=1e6,
     help="file_byte_budget")
+parser.add_argument('-w', '--num_workers',
+    required=False, type=int, default=1,
+    help="number of processes counting tokens. Default=1")
 
 def main():
     opt = parser.parse_args()
@@ -33,8 +36,9 @@ def main():
     dataset_filename = opt.dataset_filename
     file_byte_budget = opt.file_byte_budget
 
+    # token counts are cached in data_dir, and reused across vocab sizes
     utils.get_or_generate_vocab(data_dir, vocab_filename, vocab_size, 
-        dataset_filename, file_byte_budget, 4)
+        dataset_filename, file_byte_budget, 4, num_workers=opt.num_workers)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parallel search for a SubwordTextEncoder of a target vocab size.
+
+SubwordTextEncoder.build_to_target_size bisects over min_count, running a
+full build_from_token_counts at each probe, one at a time. Here each round
+builds several min_count candidates at once in a process pool. Vocab size
+decreases as min_count grows, so each round narrows the search interval to
+the candidates around the target. Search stops once a candidate is within
+tolerance of the target size.
+"""
+import tensorflow as tf
+import os
+import time
+import shutil
+import tempfile
+import logging
+import multiprocessing
+
+from tensor2tensor.data_generators import text_encoder
+
+# token counts shared with worker processes, set by _init_worker
+_TOKEN_COUNTS = None
+
+class _IterationTimer(logging.Handler):
+    """Records the time of each "Iteration" message logged by
+    SubwordTextEncoder.build_from_token_counts.
+    """
+
+    def __init__(self):
+        super(_IterationTimer, self).__init__()
+        self.times = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        if message.startswith("Iteration") or message.startswith("vocab_size"):
+            self.times.append(record.created)
+
+    def iteration_secs(self):
+        # each iteration starts with "Iteration i" and ends with "vocab_size = n"
+        return [end - start for start, end in zip(self.times[::2], self.times[1::2])]
+
+def _init_worker(token_counts):
+    global _TOKEN_COUNTS
+    _TOKEN_COUNTS = token_counts
+
+def _build_candidate(args):
+    """Build vocab with min_count, store it to vocab_filepath.
+    Returns (min_count, vocab_size, seconds, seconds per iteration).
+    """
+    min_count, num_iterations, vocab_filepath = args
+    timer = _IterationTimer()
+    logger = logging.getLogger("tensorflow")
+    logger.addHandler(timer)
+    try:
+        start = time.time()
+        subtokenizer = text_encoder.SubwordTextEncoder()
+        subtokenizer.build_from_token_counts(_TOKEN_COUNTS, min_count, num_iterations)
+        secs = time.time() - start
+    finally:
+        logger.removeHandler(timer)
+    subtokenizer.store_to_file(vocab_filepath)
+    return min_count, subtokenizer.vocab_size, secs, timer.iteration_secs()
+
+def _candidates(lo, hi, num_candidates):
+    """Up to num_candidates min_counts evenly spread over [lo, hi]"""
+    if hi - lo + 1 <= num_candidates:
+        return list(range(lo, hi + 1))
+    return sorted(set(lo + (hi - lo) * (i + 1) // (num_candidates + 1)
+                      for i in range(num_candidates)))
+
+def build_to_target_size(target_size, token_counts, min_val, max_val,
+                         num_iterations=4, num_workers=4, tolerance=0.01):
+    """Builds a SubwordTextEncoder with vocab_size near target_size.
+    Parallel version of SubwordTextEncoder.build_to_target_size.
+
+    Args:
+        target_size: desired vocab_size
+        token_counts: dict of token counts, mapping string to int
+        min_val: lower bound for the minimum token count
+        max_val: upper bound for the minimum token count
+        num_iterations: iterations of refinement for each candidate
+        num_workers: number of candidates built at once
+        tolerance: stop once a candidate is within this fraction of target_size
+
+    Returns:
+        A SubwordTextEncoder instance.
+    """
+    if min_val > max_val:
+        raise ValueError("Lower bound for the minimum token count "
+                         "is greater than the upper bound.")
+    # build_from_token_counts treats min_count < 1 as 1
+    lo, hi = max(int(min_val), 1), max(int(max_val), 1)
+
+    tmp_dir = tempfile.mkdtemp(prefix="vocab_builder")
+    best = None  # (distance to target, min_count, vocab_filepath)
+    pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                initargs=(token_counts,))
+    try:
+        start = time.time()
+        while lo <= hi:
+            tasks = [(min_count, num_iterations, os.path.join(tmp_dir, "vocab.%d" % min_count))
+                     for min_count in _candidates(lo, hi, num_workers)]
+            results = pool.map(_build_candidate, tasks)
+
+            for min_count, vocab_size, secs, iteration_secs in results:
+                tf.logging.info("[vocab_builder] min_count=%d: vocab_size=%d, %.1fs, iterations: %s" %
+                    (min_count, vocab_size, secs, ", ".join("%.1fs" % s for s in iteration_secs)))
+                distance = abs(vocab_size - target_size)
+                if best is None or distance < best[0]:
+                    best = (distance, min_count, os.path.join(tmp_dir, "vocab.%d" % min_count))
+
+            if best[0] <= tolerance * target_size:
+                break
+
+            # vocab size decreases with min_count
+            for min_count, vocab_size, _, _ in results:
+                if vocab_size > target_size:
+                    lo = max(lo, min_count + 1)
+                else:
+                    hi = min(hi, min_count - 1)
+
+        tf.logging.info("[vocab_builder] picked min_count=%d, %.1fs total" %
+                        (best[1], time.time() - start))
+        return text_encoder.SubwordTextEncoder(best[2])
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
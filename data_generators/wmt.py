@@ -10,17 +10,38 @@ import tensorflow as tf
 from tensor2tensor.utils import registry
 from tensor2tensor.data_generators import problem
 from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.data_generators import generator_utils
 from tensor2tensor.data_generators.translate import TranslateProblem
 
 import random
 import io
+import multiprocessing
 
 from . import utils
 from . import preprocess
+from . import cache
+from . import encoded
+from . import encoder_cache
+from . import bucketing
+from . import pipeline
+from . import compressed
 
 # End-of-sentence marker.
 EOS = text_encoder.EOS_ID
 
+# stage cache directory, relative to tmp_dir
+_STAGE_CACHE_DIR = "stage_cache"
+
+# persistent segmentation cache, in the stage cache directory
+_SEGMENT_CACHE_FILE = "segment_cache.sqlite"
+
+# clean_parallel filters of the training corpus
+_CLEAN_PARAMS = dict(max_ratio=9.0, min_ratio=0.1111, min_src_len=5)
+_CLEAN_DEDUP = "hash64"
+
+# dataset names of the training corpus, see provenance.py
+_TRAIN_NAMES = ["news_commentary", "cwmt_a", "cwmt_b", "un"]
+
 # 227k lines
 _ZHEN_TRAIN_DATASETS = [[
         "http://data.statmt.org/wmt17/translation-task/training-parallel-nc-v12.tgz",
@@ -125,6 +146,56 @@ class TranslateEnzhWmt(TranslateProblem):
     def target_vocab_filename(self):
         return "vocab.zh.%d" % self.vocab_size
 
+    @property
+    def num_datagen_workers(self):
+        """Number of processes used for segmentation, cleaning, vocab and encoding"""
+        return multiprocessing.cpu_count()
+
+    @property
+    def max_subword_length(self):
+        """Training examples with a longer source or target, eos included, are 
+        dropped at datagen time, e.g. 256 for max_length of transformer_base. 
+        None for no limit. The dev set is never filtered.
+        """
+        return None
+
+    @property
+    def max_example_tokens(self):
+        """Training examples with more source and target tokens, eos included, 
+        are dropped at datagen time. None for no limit. The dev set is never filtered.
+        """
+        return None
+
+    @property
+    def length_bucket_boundaries(self):
+        """Bucket boundaries for length-bucketed training shards, see bucketing.py.
+        None writes shuffled shards as usual.
+        """
+        return None
+
+    @property
+    def persistent_segment_cache(self):
+        """Store jieba segmentations in tmp_dir/stage_cache, shared across runs
+        and problems, see segment_cache.py. False keeps them in memory only.
+        """
+        return True
+
+    @property
+    def fused_pipeline(self):
+        """Stream the training corpus from the stage artifacts through cleaning
+        into the encoder, without writing train.tok.*, see pipeline.py.
+        train.tok.clean.* is only written while the vocab is missing.
+        """
+        return False
+
+    @property
+    def compress_intermediates(self):
+        """Write stage artifacts and text corpora (train.tok.*, train.tok.clean.*,
+        dev.tok.*, ...) block-compressed, see compressed.py. Readers detect
+        the format, so existing plain files are still read.
+        """
+        return False
+
     @property
     def input_space_id(self):
         return problem.SpaceID.EN_TOK
@@ -138,11 +209,13 @@ class TranslateEnzhWmt(TranslateProblem):
     ## 
     def get_source_vocab(self, data_dir):
         return utils.get_or_generate_vocab(data_dir, self.source_vocab_filename,
-            self.vocab_size, "train.tok.clean.en", _file_byte_budget=5e8, num_iterations=4)
+            self.vocab_size, "train.tok.clean.en", _file_byte_budget=5e8, num_iterations=4,
+            num_workers=self.num_datagen_workers)
 
     def get_target_vocab(self, data_dir):
         return utils.get_or_generate_vocab(data_dir, self.target_vocab_filename,
-            self.vocab_size, "train.tok.clean.zh", _file_byte_budget=5e8, num_iterations=4)
+            self.vocab_size, "train.tok.clean.zh", _file_byte_budget=5e8, num_iterations=4,
+            num_workers=self.num_datagen_workers)
     
     ##
     ## generators and stuff
@@ -150,33 +223,81 @@ class TranslateEnzhWmt(TranslateProblem):
 
     def prepare(self, data_dir, tmp_dir):
         # custom pipeline for preparing WMT dataset
-        prepare_wmt_data(data_dir, tmp_dir)
+        compressed.use_compression(self.compress_intermediates)
+        prepare_wmt_data(data_dir, tmp_dir, self.num_datagen_workers,
+            self.persistent_segment_cache, fused=self.fused_pipeline)
 
-    def generator(self, data_dir, tmp_dir, train):
-        """Generator for graph input. 
-        Prepares dataset, build vocab, and feed dataset into generator. 
+    def encoded_corpus(self, data_dir, tmp_dir, train):
+        """EncodedCorpus of training or dev dataset.
+        Prepares dataset, build vocab, and encode dataset if needed.
         """
         self.prepare(data_dir, tmp_dir)
+        vocab_filepaths = [os.path.join(data_dir, self.source_vocab_filename),
+                           os.path.join(data_dir, self.target_vocab_filename)]
+        data_filename = "train.tok.clean" if train else "dev.tok"   
+        source_filepath = os.path.join(data_dir, data_filename + ".en")
+        target_filepath = os.path.join(data_dir, data_filename + ".zh")
+
+        fused = train and self.fused_pipeline
+        if fused:
+            artifact_lists = prepare_wmt_train_artifacts(tmp_dir, self.num_datagen_workers)
+            # the vocab is sampled from train.tok.clean, write it only until the vocab exists
+            if not utils.do_files_exist(vocab_filepaths) and \
+                    not utils.do_files_exist([source_filepath, target_filepath]):
+                pipeline.write_clean(artifact_lists, _TRAIN_NAMES,
+                    [source_filepath, target_filepath], _CLEAN_PARAMS, _CLEAN_DEDUP)
 
         # build vocab on training dataset
         source_vocab = self.get_source_vocab(data_dir)
         target_vocab = self.get_target_vocab(data_dir)
         tf.logging.info("[generator] vocab sizes, source: %d, target: %d" %
                         (source_vocab.vocab_size, target_vocab.vocab_size))
-        
-        data_filename = "train.tok.clean" if train else "dev.tok"   
-        source_filepath = os.path.join(data_dir, data_filename + ".en")
-        target_filepath = os.path.join(data_dir, data_filename + ".zh")
+
+        # encode once to binary format, re-runs stream token ids from disk
+        # limits exclude the eos appended by the generator, dev is kept complete 
+        # so eval metrics stay comparable
+        max_length = train and self.max_subword_length and self.max_subword_length - 1
+        max_tokens = train and self.max_example_tokens and self.max_example_tokens - 2
+        if fused:
+            return pipeline.get_or_encode_stream(artifact_lists, _TRAIN_NAMES,
+                source_vocab, target_vocab, os.path.join(data_dir, data_filename + ".enc"),
+                vocab_filepaths, _CLEAN_PARAMS, _CLEAN_DEDUP, self.num_datagen_workers,
+                max_length=max_length, max_tokens=max_tokens)
+
         tf.logging.info("[generator] filepaths: %s, %s" % (source_filepath, target_filepath))
+        corpus = encoded.get_or_encode(source_filepath, target_filepath,
+            source_vocab, target_vocab, os.path.join(data_dir, data_filename + ".enc"),
+            vocab_filepaths, num_workers=self.num_datagen_workers,
+            max_length=max_length, max_tokens=max_tokens)
+        return corpus
+
+    def generator(self, data_dir, tmp_dir, train):
+        """Generator for graph input. 
+        Prepares dataset, build vocab, and feed dataset into generator. 
+        """
+        corpus = self.encoded_corpus(data_dir, tmp_dir, train)
+        return encoded.encoded_token_generator(corpus, EOS)
+
+    def generate_data(self, data_dir, tmp_dir, task_id=-1):
+        boundaries = self.length_bucket_boundaries
+        if boundaries is None:
+            return super(TranslateEnzhWmt, self).generate_data(data_dir, tmp_dir, task_id)
 
-        return utils.bi_vocabs_token_generator(source_filepath, target_filepath, 
-            source_vocab, target_vocab, EOS)
+        # training shards grouped by length bucket and sorted by length, not shuffled
+        train_paths = self.training_filepaths(data_dir, self.num_shards, shuffled=True)
+        bucketing.generate_bucketed_files(self.encoded_corpus(data_dir, tmp_dir, True),
+            train_paths, EOS, boundaries,
+            histogram_path=os.path.join(data_dir, "%s-train.histogram.json" % self.name))
+
+        dev_paths = self.dev_filepaths(data_dir, self.num_dev_shards, shuffled=True)
+        generator_utils.generate_files(self.generator(data_dir, tmp_dir, False), dev_paths)
 
     def feature_encoders(self, data_dir):
-        source_token = text_encoder.SubwordTextEncoder(
-            os.path.join(data_dir, self.source_vocab_filename))
-        target_token = text_encoder.SubwordTextEncoder(
-            os.path.join(data_dir, self.target_vocab_filename))
+        # memoized encoding for repetitive decode inputs, see encoder_cache
+        source_token = encoder_cache.cached(text_encoder.SubwordTextEncoder(
+            os.path.join(data_dir, self.source_vocab_filename)))
+        target_token = encoder_cache.cached(text_encoder.SubwordTextEncoder(
+            os.path.join(data_dir, self.target_vocab_filename)))
         return {
             "inputs": source_token,
             "targets": target_token,
@@ -189,57 +310,115 @@ class TranslateEnzhWmtPreproc(TranslateEnzhWmt):
 
     def prepare(self, data_dir, tmp_dir):
         # custom pipeline for preparing WMT dataset
-        prepare_wmt_data_addtl_preproc(data_dir, tmp_dir)
+        compressed.use_compression(self.compress_intermediates)
+        prepare_wmt_data_addtl_preproc(data_dir, tmp_dir, self.num_datagen_workers,
+            self.persistent_segment_cache)
+
+
+@registry.register_problem
+class TranslateEnzhWmtFused(TranslateEnzhWmt):
+    """WMT17 Zh-En translation, training corpus prepared in a single streaming pass. """
+
+    @property
+    def fused_pipeline(self):
+        return True
+
+
+@registry.register_problem
+class TranslateEnzhWmtBucketed(TranslateEnzhWmt):
+    """WMT17 Zh-En translation, with length-bucketed training shards. """
+
+    @property
+    def length_bucket_boundaries(self):
+        return bucketing.BUCKET_BOUNDARIES
 
 
 ##
 ## Preprocessing
 ##
 
-def prepare_wmt_data(data_dir, tmp_dir):
+def _segment_cache(cache_dir, persistent=True):
+    """Segmentation cache of utils._preprocess, stored in cache_dir if persistent"""
+    if not persistent:
+        return utils.use_segment_cache()
+    tf.gfile.MakeDirs(cache_dir)
+    return utils.use_segment_cache(os.path.join(cache_dir, _SEGMENT_CACHE_FILE))
+
+def prepare_wmt_train_artifacts(tmp_dir, num_workers=1):
+    """Preprocess the training datasets to the stage cache, see cache.py.
+
+    Returns:
+        list of dicts lang -> artifact paths, one per dataset of _TRAIN_NAMES
+    """
+    cache_dir = os.path.join(tmp_dir, _STAGE_CACHE_DIR)
+
+    # news commentary
+    tf.logging.info("[prepare_wmt_data] preparing News Commentary dataset")
+    nc = cache.prepare_data_cached(tmp_dir, _ZHEN_TRAIN_DATASETS, cache_dir,
+        num_workers=num_workers)
+
+    # append additional training data using cwmt corpuses
+    tf.logging.info("[prepare_wmt_data] appending CWMT A datasets")
+    cwmt_a = cache.prepare_data_cached(tmp_dir, _CWMT_TRAIN_A_DATASETS, cache_dir,
+        num_workers=num_workers)
+
+    tf.logging.info("[prepare_wmt_data] appending CWMT B datasets")
+    cwmt_b = cache.prepare_data_cached(tmp_dir, _CWMT_TRAIN_B_DATASETS, cache_dir,
+        use_jieba=False, num_workers=num_workers)
+
+    # append additional training data using UN parallel corpuses
+    tf.logging.info("[prepare_wmt_data] appending UN parallel datasets")
+    un = cache.prepare_data_cached(tmp_dir, _UN_TRAIN_DATASETS, cache_dir,
+        num_workers=num_workers)
+    return [nc, cwmt_a, cwmt_b, un]
+
+def prepare_wmt_data(data_dir, tmp_dir, num_workers=1,
+        persistent_segment_cache=True, fused=False):
     """ Prepare datasets for WMT17 ZH-EN.
     Download and preprocesses datasets if not cached on disk.   
     Then append additional parallel corpus from CWMT to training.
     This preprocessing uses jieba tokenizer for Chinese corpus 
-    """
-    # prepare training dataset if it isn't already available
-    train_corpus_paths = [os.path.join(data_dir, "train.tok.%s" % lang) for lang in ["en", "zh"]]
-    if not utils.do_files_exist(train_corpus_paths):
-        
-        # news commentary
-        tf.logging.info("[prepare_wmt_data] preparing News Commentary dataset")
-        utils.prepare_data(data_dir, tmp_dir, _ZHEN_TRAIN_DATASETS, 
-            "train.tok")
 
-        # append additional training data using cwmt corpuses
-        tf.logging.info("[prepare_wmt_data] appending CWMT A datasets")
-        utils.prepare_data(data_dir, tmp_dir, _CWMT_TRAIN_A_DATASETS,
-            "train.tok")
+    Each dataset is preprocessed to its own artifact in the stage cache,
+    see cache.py, so an interrupted run only redoes the missing datasets. 
 
-        tf.logging.info("[prepare_wmt_data] appending CWMT B datasets")
-        utils.prepare_data(data_dir, tmp_dir, _CWMT_TRAIN_B_DATASETS,
-            "train.tok", use_jieba=False)
+    num_workers: number of processes used for jieba segmentation
+    persistent_segment_cache: store segmentations in the stage cache, 
+        see _segment_cache
+    fused: only preprocess the training datasets to the stage cache, 
+        the training corpus is streamed from there, see pipeline.py
+    """
+    cache_dir = os.path.join(tmp_dir, _STAGE_CACHE_DIR)
+    segment_cache = _segment_cache(cache_dir, persistent_segment_cache)
 
-        # append additional training data using UN parallel corpuses
-        tf.logging.info("[prepare_wmt_data] appending UN parallel datasets")
-        utils.prepare_data(data_dir, tmp_dir, _UN_TRAIN_DATASETS,
-            "train.tok")
+    # prepare training dataset if it isn't already available
+    train_corpus_paths = [os.path.join(data_dir, "train.tok.%s" % lang) for lang in ["en", "zh"]]
+    if fused:
+        prepare_wmt_train_artifacts(tmp_dir, num_workers)
+    elif not utils.do_files_exist(train_corpus_paths):
+        cache.merge_artifacts(prepare_wmt_train_artifacts(tmp_dir, num_workers),
+            data_dir, "train.tok", names=_TRAIN_NAMES)
 
     # cleaned dataset, if not available yet
     train_clean_paths = [os.path.join(data_dir, "train.tok.clean.%s" % lang) for lang in ["en", "zh"]]
-    if not utils.do_files_exist(train_clean_paths):
+    if not fused and not utils.do_files_exist(train_clean_paths):
         utils.clean_parallel(train_corpus_paths, train_clean_paths, 
-            max_ratio=9.0, min_ratio=0.1111, min_src_len=5)
+            dedup=_CLEAN_DEDUP, num_workers=num_workers, **_CLEAN_PARAMS)
 
     # prepare dev dataset if it isn't already available
     dev_corpus_paths = [os.path.join(data_dir, "dev.tok.%s" % lang) for lang in ["zh", "en"]]    
     if not utils.do_files_exist(dev_corpus_paths):
         # news commentary
         tf.logging.info("[prepare_wmt_data] preparing News Commentary dev dataset")
-        utils.prepare_data(data_dir, tmp_dir, _ZHEN_TEST_DATASETS, 
-            "dev.tok")
+        dev = cache.prepare_data_cached(tmp_dir, _ZHEN_TEST_DATASETS, cache_dir,
+            num_workers=num_workers)
+        cache.merge_artifacts([dev], data_dir, "dev.tok", names=["newsdev2017"])
+
+    segment_cache.log_stats("prepare_wmt_data")
+    segment_cache.close()
 
-def prepare_wmt_data_addtl_preproc(data_dir, tmp_dir):
+def prepare_wmt_data_addtl_preproc(data_dir, tmp_dir, num_workers=1,
+        persistent_segment_cache=True):
     """ Prepare datasets for WMT17 ZH-EN.
     Download and preprocesses datasets if not cached on disk. 
 
@@ -249,38 +428,55 @@ def prepare_wmt_data_addtl_preproc(data_dir, tmp_dir):
     News Commentary also requires additional cleaning and preprocessing.
     
     Then append additional parallel corpus from CWMT to training. 
+
+    num_workers: number of processes used for jieba segmentation
+    persistent_segment_cache: store segmentations in the stage cache, 
+        see _segment_cache
     """
+    cache_dir = os.path.join(tmp_dir, _STAGE_CACHE_DIR)
+    segment_cache = _segment_cache(cache_dir, persistent_segment_cache)
+
     # prepare training dataset if it isn't already available
-    train_corpus_paths = [os.path.join(data_dir, "train.tok.%s" % lang) for lang in ["zh", "en"]]
+    train_corpus_paths = [os.path.join(data_dir, "train.tok.%s" % lang) for lang in ["en", "zh"]]
     if not utils.do_files_exist(train_corpus_paths):
         
         # news commentary
         tf.logging.info("[prepare_wmt_addtl] preparing News Commentary dataset")
-        utils.prepare_data(data_dir, tmp_dir, _ZHEN_TRAIN_DATASETS, 
-            "nc.train.tok")
+        nc = cache.prepare_data_cached(tmp_dir, _ZHEN_TRAIN_DATASETS, cache_dir,
+            num_workers=num_workers)
+        nc_corpus_paths = [os.path.join(data_dir, "nc.train.tok.%s" % lang) for lang in ["en", "zh"]]
+        if not utils.do_files_exist(nc_corpus_paths):
+            cache.merge_artifacts([nc], data_dir, "nc.train.tok")
 
         # additional preprocessing is required for nc dataset
         # in addition, we hold out 2000 sentences from this dataset
         # we use this as our dev set
         tf.logging.info("[prepare_wmt_addtl] running addtl preprocessing")
-        preprocess.preprocess_nc(data_dir, "nc.train.tok", "train.tok", "dev.tok", 2000)
+        preprocess.preprocess_nc(data_dir, "nc.train.tok", "nc.split.tok", "dev.tok", 2000)
+        nc_split = {lang: [os.path.join(data_dir, "nc.split.tok.%s" % lang)] for lang in ["en", "zh"]}
 
         # append additional training data using cwmt corpuses
         tf.logging.info("[prepare_wmt_addtl] appending CWMT A datasets")
-        utils.prepare_data(data_dir, tmp_dir, _CWMT_TRAIN_A_DATASETS,
-            "train.tok")
+        cwmt_a = cache.prepare_data_cached(tmp_dir, _CWMT_TRAIN_A_DATASETS, cache_dir,
+            num_workers=num_workers)
 
         tf.logging.info("[prepare_wmt_addtl] appending CWMT B datasets")
-        utils.prepare_data(data_dir, tmp_dir, _CWMT_TRAIN_B_DATASETS,
-            "train.tok", use_jieba=False)
+        cwmt_b = cache.prepare_data_cached(tmp_dir, _CWMT_TRAIN_B_DATASETS, cache_dir,
+            use_jieba=False, num_workers=num_workers)
 
         # append additional training data using UN parallel corpuses
         tf.logging.info("[prepare_wmt_addtl] appending UN parallel datasets")
-        utils.prepare_data(data_dir, tmp_dir, _UN_TRAIN_DATASETS,
-            "train.tok")
-
-        # cleaned dataset, if not available yet
-        train_clean_paths = [os.path.join(data_dir, "train.tok.clean.%s" % lang) for lang in ["en", "zh"]]
-        if not utils.do_files_exist(train_clean_paths):
-            utils.clean_parallel(train_corpus_paths, train_clean_paths, 
-                max_ratio=9.0, min_ratio=0.1111, min_src_len=5)
+        un = cache.prepare_data_cached(tmp_dir, _UN_TRAIN_DATASETS, cache_dir,
+            num_workers=num_workers)
+
+        cache.merge_artifacts([nc_split, cwmt_a, cwmt_b, un], data_dir, "train.tok",
+            names=["news_commentary", "cwmt_a", "cwmt_b", "un"])
+
+    # cleaned dataset, if not available yet
+    train_clean_paths = [os.path.join(data_dir, "train.tok.clean.%s" % lang) for lang in ["en", "zh"]]
+    if not utils.do_files_exist(train_clean_paths):
+        utils.clean_parallel(train_corpus_paths, train_clean_paths, 
+            dedup=_CLEAN_DEDUP, num_workers=num_workers, **_CLEAN_PARAMS)
+
+    segment_cache.log_stats("prepare_wmt_addtl")
+    segment_cache.close()
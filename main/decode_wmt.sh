@@ -45,15 +45,19 @@ fi
 DECODED=$DECODE_FILE.$MODEL.$HPARAMS.$PROBLEM.beam$BEAM_SIZE.alpha$ALPHA.decodes
 if [ ! -f $DECODED ]; then 
   echo "Starting Decoder...."
-  t2t-decoder \
+  # length-sorted, token-budgeted batches, see utils/decode_file.py
+  python -m utils.decode_file \
     --t2t_usr_dir=./data_generators \
     --data_dir=$DATA_DIR \
-    --problems=$PROBLEM \
+    --problem=$PROBLEM \
     --model=$MODEL \
     --hparams_set=$HPARAMS \
     --output_dir=$TRAIN_DIR \
-    --decode_hparams="beam_size=$BEAM_SIZE,alpha=$ALPHA" \
-    --decode_from_file=$DECODE_FILE
+    --beam_size=$BEAM_SIZE \
+    --alpha=$ALPHA \
+    --max_tokens=4096 \
+    --decode_from_file=$DECODE_FILE \
+    --decode_to_file=$DECODED
   
   echo "Decoded to ${DECODED}"
 fi
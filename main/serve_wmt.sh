@@ -0,0 +1,26 @@
+#!/bin/bash
+
+# serve wmt17 zh-en translations over http, on CPU
+# client: echo "Hello world" | python -m utils.translate_server --client
+DATA_DIR=data/wmt
+TRAIN_DIR=train/wmt
+PROBLEM=translate_enzh_wmt
+HPARAMS=transformer_base_single_gpu
+MODEL=transformer
+
+# decode hparams
+BEAM_SIZE=4
+ALPHA=0.6
+
+python -m utils.translate_server \
+  --t2t_usr_dir=./data_generators \
+  --data_dir=$DATA_DIR \
+  --problem=$PROBLEM \
+  --model=$MODEL \
+  --hparams_set=$HPARAMS \
+  --output_dir=$TRAIN_DIR \
+  --beam_size=$BEAM_SIZE \
+  --alpha=$ALPHA \
+  --port=8500 \
+  --max_batch_size=32 \
+  --max_latency_ms=50
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Startup cost of the t2t_usr_dir package.
+
+Times fresh python processes, from the repo root:
+    baseline:   import tensorflow and tensor2tensor, as t2t-trainer does
+    usr_dir:    baseline + import data_generators (registers the problems)
+    segment:    usr_dir + segment one Chinese line, which loads jieba
+
+usr_dir - baseline is what every t2t-trainer / t2t-decoder run pays for
+--t2t_usr_dir=./data_generators; segment - usr_dir is the jieba dictionary
+load, which used to be paid at import time.
+
+    python tools/bench_startup.py -n 5
+"""
+from __future__ import print_function
+import argparse
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--repeat', type=int, default=5, help='runs per case')
+
+_BASELINE = "import tensorflow, tensor2tensor.data_generators.translate"
+
+CASES = [
+    ("baseline", _BASELINE),
+    ("usr_dir", _BASELINE + "; import data_generators"),
+    ("segment", _BASELINE + "; import data_generators; "
+                "data_generators.utils._preprocess(u'\\u4e2d\\u6587\\u5206\\u8bcd', True)"),
+]
+
+def time_case(code, repeat):
+    """Wall time of fresh processes running code, best and mean of repeat runs"""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", code])
+        times.append(time.time() - start)
+    return min(times), sum(times) / len(times)
+
+def main():
+    opt = parser.parse_args()
+    results = {}
+    for name, code in CASES:
+        results[name] = time_case(code, opt.repeat)
+        print("%-10s best %.2fs, mean %.2fs" % ((name,) + results[name]))
+    print("import data_generators: %.2fs" % (results["usr_dir"][0] - results["baseline"][0]))
+    print("first segmentation (jieba load): %.2fs" % (results["segment"][0] - results["usr_dir"][0]))
+
+if __name__ == "__main__":
+    main()
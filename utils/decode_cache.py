@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent sentence-level translation cache.
+
+Hypotheses are stored in a sqlite file, keyed on the model (checkpoint,
+problem, hparams, beam_size, alpha) and the normalized source sentence, so
+repeated evaluation runs and the translation server only decode sentences
+not seen before with the same model and decode settings. The store is
+bounded: once it holds more than max_entries, the least recently used
+entries are evicted.
+"""
+import tensorflow as tf
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from . import translator as translator_utils
+
+# default max number of cached sentences
+MAX_ENTRIES = 1000000
+
+# fraction of max_entries kept after an eviction
+_EVICT_TO = 0.9
+
+def _checkpoint_fingerprint(checkpoint_path):
+    """md5 of the checkpoint .index file, which changes with the weights' layout
+    and offsets, plus the checkpoint name, e.g. model.ckpt-240000
+    """
+    md5 = hashlib.md5()
+    index_path = checkpoint_path + ".index"
+    if tf.gfile.Exists(index_path):
+        with tf.gfile.GFile(index_path, mode="rb") as f:
+            md5.update(f.read())
+    return "%s-%s" % (os.path.basename(checkpoint_path), md5.hexdigest()[:16])
+
+def model_key(checkpoint_path, problem, hparams_set, hparams, beam_size, alpha):
+    """Cache key of a model and its decode settings"""
+    key = json.dumps([_checkpoint_fingerprint(checkpoint_path), problem, hparams_set,
+                      hparams, int(beam_size), float(alpha)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def translator_key(translator):
+    """Cache key of a Translator"""
+    return model_key(translator.checkpoint_path, translator.problem_name,
+        translator.hparams_set, translator.hparams_overrides,
+        translator.beam_size, translator.alpha)
+
+class DecodeCache(object):
+    """Hypotheses of one model, in a sqlite store shared by all models.
+
+    Args:
+        path: sqlite file
+        model_key: see model_key, translator_key
+        max_entries: max sentences in the store, over all models
+    """
+
+    def __init__(self, path, model_key, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.model_key = model_key
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # used from the batching thread of translate_server
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS decodes "
+                         "(key TEXT PRIMARY KEY, hyp TEXT, last_used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS decodes_last_used ON decodes (last_used)")
+        self._db.commit()
+
+    def _key(self, sentence):
+        source = translator_utils.normalize_source(sentence)
+        return hashlib.sha1((self.model_key + "\0" + source).encode("utf-8")).hexdigest()
+
+    def get_many(self, sentences):
+        """Cached hypothesis of each sentence, None if missing"""
+        keys = [self._key(s) for s in sentences]
+        found = {}
+        with self._lock:
+            # sqlite limits the number of query parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self._db.execute("SELECT key, hyp FROM decodes WHERE key IN (%s)" %
+                                        ",".join("?" * len(chunk)), chunk)
+                found.update(rows.fetchall())
+            now = time.time()
+            self._db.executemany("UPDATE decodes SET last_used = ? WHERE key = ?",
+                                 [(now, key) for key in found])
+            self._db.commit()
+        hyps = [found.get(key) for key in keys]
+        num_hits = sum(hyp is not None for hyp in hyps)
+        self.hits += num_hits
+        self.misses += len(hyps) - num_hits
+        return hyps
+
+    def put_many(self, sentences, hyps):
+        now = time.time()
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO decodes VALUES (?, ?, ?)",
+                                 [(self._key(s), hyp, now) for s, hyp in zip(sentences, hyps)])
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        count = self._db.execute("SELECT COUNT(*) FROM decodes").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        num_evict = count - int(_EVICT_TO * self.max_entries)
+        self._db.execute("DELETE FROM decodes WHERE key IN "
+                         "(SELECT key FROM decodes ORDER BY last_used LIMIT ?)", (num_evict,))
+        tf.logging.info("[decode_cache] evicted %d entries" % num_evict)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM decodes").fetchone()[0]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
+
+    def log_stats(self):
+        tf.logging.info("[decode_cache] %s: hit rate %.3f (%d hits, %d misses)" %
+                        (self.path, self.hit_rate(), self.hits, self.misses))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def cached_translate(translate_fn, cache):
+    """translate_fn that only translates sentences missing from cache"""
+    def translate(sentences):
+        hyps = cache.get_many(sentences)
+        missing = [i for i, hyp in enumerate(hyps) if hyp is None]
+        if missing:
+            translated = translate_fn([sentences[i] for i in missing])
+            cache.put_many([sentences[i] for i in missing], translated)
+            for i, hyp in zip(missing, translated):
+                hyps[i] = hyp
+        return hyps
+    return translate
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Length-sorted batched decoding of a file.
+
+Encodes every line of the input file, sorts sentences by subword length and
+decodes them in batches of similar length, cut by a token budget, so little
+beam search work is spent on padding. Hypotheses are written back in the
+original line order, to the same .decodes filename t2t-decoder uses, and a
+throughput report is printed. With --cache_path, sentences already decoded
+with the same model and settings are read from a decode cache, see
+decode_cache.py.
+
+    python -m utils.decode_file --decode_from_file=decode/wmt/test.en \\
+        --data_dir=data/wmt --output_dir=train/wmt --beam_size=4 --alpha=0.6
+"""
+from __future__ import print_function
+import tensorflow as tf
+import io
+import json
+import time
+import argparse
+
+from . import translator as translator_utils
+from . import decode_cache
+
+def decode_filename(base_filename, model, hparams_set, problem, beam_size, alpha):
+    """Output filename, same as t2t-decoder --decode_from_file"""
+    return "{base}.{model}.{hp}.{problem}.beam{beam}.alpha{alpha}.decodes".format(
+        base=base_filename, model=model, hp=hparams_set, problem=problem,
+        beam=str(beam_size), alpha=str(alpha))
+
+def decode_file(translator, filename, decode_to_file, max_tokens=4096, max_batch_size=128,
+                cache=None):
+    """Decode lines of filename with translator, write hypotheses in line
+    order to decode_to_file.
+
+    Args:
+        cache: DecodeCache of translator, only missing sentences are decoded
+
+    Returns:
+        dict throughput report, over the decoded sentences
+    """
+    with io.open(filename, "r", encoding="utf-8") as f:
+        sources = [translator_utils.normalize_source(line) for line in f]
+
+    hyps = cache.get_many(sources) if cache is not None else [None] * len(sources)
+    todo = [i for i, hyp in enumerate(hyps) if hyp is None]
+
+    start = time.time()
+    inputs = [translator.encode(sources[i]) for i in todo]
+    lengths = [len(ids) for ids in inputs]
+    batches = translator_utils.token_batches(lengths, max_tokens, max_batch_size)
+    encode_secs = time.time() - start
+
+    outputs = [None] * len(inputs)
+    padded_tokens = 0
+    start = time.time()
+    for b, batch in enumerate(batches):
+        batch_start = time.time()
+        for i, ids in zip(batch, translator.translate_ids([inputs[i] for i in batch])):
+            outputs[i] = ids
+        padded_tokens += len(batch) * lengths[batch[0]]
+        tf.logging.info("[decode_file] batch %d/%d: %d sentences x %d tokens, %.2fs" %
+            (b + 1, len(batches), len(batch), lengths[batch[0]], time.time() - batch_start))
+    decode_secs = time.time() - start
+
+    decoded = [translator.target_vocab.decode(ids) for ids in outputs]
+    for i, hyp in zip(todo, decoded):
+        hyps[i] = hyp
+    if cache is not None:
+        cache.put_many([sources[i] for i in todo], decoded)
+        cache.log_stats()
+
+    with io.open(decode_to_file, "w", encoding="utf-8") as f:
+        for hyp in hyps:
+            f.write(hyp + u"\n")
+
+    num_source_tokens = sum(lengths)
+    num_output_tokens = sum(len(ids) for ids in outputs)
+    return {
+        "checkpoint": translator.checkpoint_path,
+        "beam_size": translator.beam_size,
+        "alpha": translator.alpha,
+        "sentences": len(todo),
+        "cached": len(sources) - len(todo),
+        "batches": len(batches),
+        "source_tokens": num_source_tokens,
+        "output_tokens": num_output_tokens,
+        "padding_fraction": 1.0 - num_source_tokens / float(padded_tokens) if padded_tokens else 0.0,
+        "encode_secs": encode_secs,
+        "decode_secs": decode_secs,
+        "sentences_per_sec": len(todo) / decode_secs if decode_secs else 0.0,
+        "source_tokens_per_sec": num_source_tokens / decode_secs if decode_secs else 0.0,
+        "output_tokens_per_sec": num_output_tokens / decode_secs if decode_secs else 0.0,
+    }
+
+def format_report(report):
+    return ("[decode_file] beam=%d alpha=%s: %d sentences in %d batches, %.1fs, %d cached\n"
+            "  %.2f sentences/s, %.1f source tokens/s, %.1f output tokens/s, %.1f%% padding" % (
+        report["beam_size"], report["alpha"], report["sentences"], report["batches"],
+        report["decode_secs"], report["cached"], report["sentences_per_sec"],
+        report["source_tokens_per_sec"], report["output_tokens_per_sec"],
+        100 * report["padding_fraction"]))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--decode_from_file', required=True, help='source sentences, one per line')
+parser.add_argument('--decode_to_file', default=None,
+    help='output file, default is the t2t-decoder .decodes filename')
+parser.add_argument('--data_dir', default='data/wmt')
+parser.add_argument('--output_dir', default='train/wmt', help='training dir with checkpoints')
+parser.add_argument('--problem', default='translate_enzh_wmt')
+parser.add_argument('--model', default='transformer')
+parser.add_argument('--hparams_set', default='transformer_base_single_gpu')
+parser.add_argument('--hparams', default='')
+parser.add_argument('--beam_size', type=int, default=4)
+parser.add_argument('--alpha', type=float, default=0.6)
+parser.add_argument('--t2t_usr_dir', default='./data_generators')
+parser.add_argument('--max_tokens', type=int, default=4096,
+    help='max padded source tokens per batch')
+parser.add_argument('--max_batch_size', type=int, default=128)
+parser.add_argument('--cpu', action='store_true', help='decode on CPU only')
+parser.add_argument('--cache_path', default=None,
+    help='sqlite decode cache, shared across runs and with translate_server')
+parser.add_argument('--cache_max_entries', type=int, default=decode_cache.MAX_ENTRIES)
+
+def main():
+    opt = parser.parse_args()
+    tf.logging.set_verbosity(tf.logging.INFO)
+    decode_to_file = opt.decode_to_file or decode_filename(opt.decode_from_file,
+        opt.model, opt.hparams_set, opt.problem, opt.beam_size, opt.alpha)
+
+    model = translator_utils.Translator(opt.data_dir, opt.output_dir, opt.problem,
+        opt.model, opt.hparams_set, opt.hparams, opt.beam_size, opt.alpha,
+        t2t_usr_dir=opt.t2t_usr_dir, cpu_only=opt.cpu)
+    cache = None
+    if opt.cache_path:
+        cache = decode_cache.DecodeCache(opt.cache_path, decode_cache.translator_key(model),
+                                         opt.cache_max_entries)
+    try:
+        report = decode_file(model, opt.decode_from_file, decode_to_file,
+                             opt.max_tokens, opt.max_batch_size, cache)
+    finally:
+        model.close()
+        if cache is not None:
+            cache.close()
+
+    print(format_report(report))
+    with open(decode_to_file + ".throughput.json", "w") as f:
+        json.dump(report, f, indent=1)
+    print("Decoded to %s" % decode_to_file)
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,258 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import time
+import random
+import threading
+
 from six.moves import zip
+from six.moves import queue
 
+import tensorflow as tf
 from tensorflow.python.platform import tf_logging as logging
 from tensorflow.python.training import session_run_hook
 from tensorflow.python.training import training_util
 
+from tensor2tensor.utils import bleu_hook
+
+from data_generators import compressed
+from data_generators import line_index
+
+from . import translator as translator_utils
+
+# sentences per batch of the background decoder
+_ASYNC_BATCH_SIZE = 64
+
+def _read_lines(filepath):
+    """Stripped lines of filepath, plain or block-compressed"""
+    with compressed.open_text(filepath, mode="r") as f:
+        return [line.strip() for line in f]
+
+def load_dev_sample(data_dir, num_samples=100, seed=0, filename="dev.tok"):
+    """Random (source, target) sample of the held-out data_dir/dev.tok.en, .zh.
+    Plain local files are sampled through their line index, reading only the
+    sampled lines, see data_generators/line_index.py. Block-compressed or
+    remote files are read in full.
+    """
+    source_path = os.path.join(data_dir, filename + ".en")
+    target_path = os.path.join(data_dir, filename + ".zh")
+    if "://" not in source_path and not compressed.is_compressed(source_path) and \
+            not compressed.is_compressed(target_path):
+        index = line_index.ParallelIndex(source_path, target_path)
+        pairs = [(s.strip(), t.strip()) for _, s, t in index.sample(num_samples, seed)]
+        index.close()
+    else:
+        pairs = list(zip(_read_lines(source_path), _read_lines(target_path)))
+        pairs = random.Random(seed).sample(pairs, min(num_samples, len(pairs)))
+    return [s for s, _ in pairs], [t for _, t in pairs]
+
+def _bleu_tokens(line):
+    """Chinese characters, and runs of other non-space characters,
+    close to tools/chi_char_segment.pl
+    """
+    return re.findall(u"[\u4e00-\u9fff]|[^\s\u4e00-\u9fff]+", line)
+
+def sample_bleu(references, hypotheses):
+    """Character-level BLEU of hypotheses, in percent"""
+    return 100 * float(bleu_hook.compute_bleu(
+        [_bleu_tokens(r) for r in references], [_bleu_tokens(h) for h in hypotheses]))
+
+def _checkpoint_step(checkpoint_path, default):
+    match = re.search(r"-(\d+)$", checkpoint_path)
+    return int(match.group(1)) if match else default
+
+class _AsyncDecoder(object):
+    """Background thread decoding the sample with the latest checkpoint snapshot.
+
+    The decode graph lives in its own graph and CPU session, built on the
+    first job. Each job restores a checkpoint, decodes, and writes results.
+    Only the newest pending job is kept, so a slow decoder skips checkpoints
+    instead of queueing them.
+    """
+
+    def __init__(self, hook):
+        self.hook = hook
+        self._jobs = queue.Queue(maxsize=1)
+        self._session = None
+        self._writer = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, checkpoint_path, step):
+        job = (checkpoint_path, step)
+        while True:
+            try:
+                self._jobs.put_nowait(job)
+                return
+            except queue.Full:
+                try:
+                    skipped = self._jobs.get_nowait()
+                    logging.info("[decode] skipping checkpoint %s" % skipped[0])
+                except queue.Empty:
+                    pass
+
+    def _build(self):
+        hook = self.hook
+        graph = tf.Graph()
+        with graph.as_default():
+            self._inputs, self._outputs = translator_utils.build_decode_graph(
+                hook.hparams, hook.model_name, hook.beam_size, hook.alpha)
+            self._saver = tf.train.Saver()
+        config = tf.ConfigProto(allow_soft_placement=True)
+        config.device_count["GPU"] = 0
+        self._session = tf.Session(graph=graph, config=config)
+        self._writer = tf.summary.FileWriter(os.path.join(hook.output_dir, "decode"))
+        # sample sorted by length, in batches
+        self._batches = translator_utils.token_batches(
+            [len(ids) for ids in hook._encoded_ids], max_batch_size=_ASYNC_BATCH_SIZE)
+
+    def _decode(self, checkpoint_path):
+        self._saver.restore(self._session, checkpoint_path)
+        decoded = [None] * len(self.hook._encoded_ids)
+        for batch in self._batches:
+            inputs = translator_utils.pad_batch([self.hook._encoded_ids[i] for i in batch])
+            outputs = self._session.run(self._outputs, feed_dict={self._inputs: inputs})
+            for i, ids in zip(batch, translator_utils.trim_outputs(outputs)):
+                decoded[i] = self.hook._targets_vocab.decode(ids)
+        return decoded
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            checkpoint_path, step = job
+            try:
+                if self._session is None:
+                    self._build()
+                start = time.time()
+                decoded = self._decode(checkpoint_path)
+                secs = time.time() - start
+                global_step = _checkpoint_step(checkpoint_path, step)
+                bleu = sample_bleu(self.hook.target, decoded)
+                self.hook._save(decoded, global_step)
+                self._writer.add_summary(tf.Summary(value=[
+                    tf.Summary.Value(tag="decode/sample_bleu", simple_value=bleu),
+                    tf.Summary.Value(tag="decode/secs", simple_value=secs),
+                ]), global_step)
+                self._writer.flush()
+                logging.info("[decode] %s: sample BLEU %.2f, %d sentences in %.1fs" %
+                    (checkpoint_path, bleu, len(decoded), secs))
+            except Exception as e:
+                logging.error("[decode] decoding %s failed: %s" % (checkpoint_path, e))
+
+    def close(self):
+        self._jobs.put(None)
+        self._thread.join()
+        if self._session is not None:
+            self._session.close()
+            self._writer.close()
+
 class DecodeHook(session_run_hook.SessionRunHook):    
     """Prints decoded sentences every N local steps, or at end. 
+
+    The decode graph is built once in begin(), sharing the training
+    variables, and the source sentences are encoded once. Each trigger
+    then costs a single session run on the fixed sample.
+
+    With async_decode, a trigger only snapshots the latest checkpoint path
+    and returns. A background thread decodes the sample with that checkpoint
+    on CPU, and writes hypotheses to output_dir, and sample BLEU to
+    TensorBoard summaries in output_dir/decode. See load_dev_sample for a
+    sample of the held-out dev.tok.
+
     params:
         source: array of source sentences
         target: array of target sentences
         output_dir: 
         output_filename: 
         every_n_iter: decode sentences every N interations
+        hparams: model hparams with problem hparams, e.g. estimator.params.
+            Decoding is disabled if None.
+        model_name: registered model name
+        beam_size: 1 for greedy decoding
+        alpha: length penalty for beam search
+        async_decode: decode in a background thread, from checkpoints
+        checkpoint_dir: training directory with checkpoints, for async_decode
     """
 
     def __init__(self, source, target, 
         output_dir, output_filename="decode.out", 
-        every_n_iter=2500):
+        every_n_iter=2500, hparams=None, model_name="transformer",
+        beam_size=1, alpha=0.6, async_decode=False, checkpoint_dir=None):
         self.source = source
         self.target = target
         self.output_dir = output_dir
         self.output_filename = output_filename
         self.every_n_iter = every_n_iter
-    
+        self.hparams = hparams
+        self.model_name = model_name
+        self.beam_size = beam_size
+        self.alpha = alpha
+        self.async_decode = async_decode
+        self.checkpoint_dir = checkpoint_dir or output_dir
+
     def begin(self):
         self._iter_count = 0
-    
+        self._inputs = None
+        self._async = None
+        self._last_checkpoint = None
+        if self.hparams is None:
+            logging.warning("[decode] no hparams given, decoding disabled")
+            return
+
+        vocabulary = self.hparams.problems[0].vocabulary
+        self._targets_vocab = vocabulary["targets"]
+        self._encoded_ids = [vocabulary["inputs"].encode(translator_utils.normalize_source(s)) +
+                             [translator_utils.EOS] for s in self.source]
+        if self.async_decode:
+            self._async = _AsyncDecoder(self)
+            return
+        self._encoded = translator_utils.pad_batch(self._encoded_ids)
+
+        # the training summary op merges all summaries,
+        # keep those of the decode graph out of it, they need a feed
+        summaries = list(tf.get_collection(tf.GraphKeys.SUMMARIES))
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+            self._inputs, self._outputs = translator_utils.build_decode_graph(
+                self.hparams, self.model_name, self.beam_size, self.alpha)
+        tf.get_collection_ref(tf.GraphKeys.SUMMARIES)[:] = summaries
+
     def after_run(self, run_context, run_values):
         sess = run_context.session
         step = self._iter_count
-        if self._should_trigger_for_step(step):
+        if self._async is not None:
+            if self._should_trigger_for_step(step):
+                self._submit_checkpoint(step)
+        elif self._should_trigger_for_step(step):
+            start = time.time()
             decoded = self._decode(sess, step)
+            if decoded:
+                self._save(decoded, step)
+            logging.info("[decode] step=%d: %d sentences in %.1f ms" %
+                (step, len(decoded), (time.time() - start) * 1000))
             self.print_decoded(decoded, step)
-        
+
         self._iter_count += 1
 
+    def end(self, session):
+        if self._async is not None:
+            # decode the final checkpoint too, and wait for the results
+            self._submit_checkpoint(self._iter_count)
+            self._async.close()
+            self._async = None
+
+    def _submit_checkpoint(self, step):
+        """Hand the latest checkpoint to the background decoder, if new"""
+        checkpoint_path = tf.train.latest_checkpoint(self.checkpoint_dir)
+        if checkpoint_path is None or checkpoint_path == self._last_checkpoint:
+            return
+        self._last_checkpoint = checkpoint_path
+        self._async.submit(checkpoint_path, step)
+
     def print_decoded(self, decoded, step):
         formatted = ["src: %s\nref: %s\nhyp: %s\n" % (src, ref, hyp) 
             for src, ref, hyp in zip(self.source, self.target, decoded)]
@@ -49,11 +264,18 @@ class DecodeHook(session_run_hook.SessionRunHook):
         return (step % self.every_n_iter) == 0
 
     def _decode(self, session, step):
-        return []
-    
-    def _save(self, session, step):
+        if self._inputs is None:
+            return []
+        outputs = session.run(self._outputs, feed_dict={self._inputs: self._encoded})
+        return [self._targets_vocab.decode(ids)
+                for ids in translator_utils.trim_outputs(outputs)]
+
+    def _save(self, decoded, step):
         """Save decoded output"""
         save_path = "%s/%s.%d" % (self.output_dir, self.output_filename, step)
-        logging.info("Saving checkpoints for %d into %s.", step, save_path)
+        logging.info("Saving decoded sentences for %d into %s.", step, save_path)
 
-        # TODO
+        tf.gfile.MakeDirs(self.output_dir)
+        with tf.gfile.GFile(save_path, mode="w") as f:
+            for hyp in decoded:
+                f.write(hyp + "\n")
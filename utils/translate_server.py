@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batch translation server.
+
+Keeps a Translator (graph, checkpoint, vocab) loaded and serves translations
+over local HTTP. Concurrent requests are grouped into dynamic batches: a
+batch is decoded once it holds max_batch_size sentences, or once its oldest
+request has waited max_latency_ms, whichever comes first. With --cache_path,
+sentences already translated by the same model are served from the decode
+cache, see decode_cache.py.
+
+    # server, on CPU
+    python -m utils.translate_server --data_dir=data/wmt --output_dir=train/wmt
+
+    # client, one sentence per line
+    echo "Hello world" | python -m utils.translate_server --client
+
+    POST /translate  {"sentences": [...]}
+        => {"translations": [...], "segmented": [...], "latency_ms": ...}
+    GET  /stats
+"""
+from __future__ import print_function
+import tensorflow as tf
+import json
+import time
+import sys
+import argparse
+import threading
+from collections import deque
+
+import six
+from six.moves import queue
+from six.moves import socketserver
+from six.moves import BaseHTTPServer
+from six.moves.urllib import request as urllib_request
+
+from . import translator as translator_utils
+from . import decode_cache
+
+# number of recent request latencies kept for stats
+_LATENCY_WINDOW = 1000
+
+class _Request(object):
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.created = time.time()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+class DynamicBatcher(object):
+    """Groups sentences of concurrent requests into batches for translate_fn,
+    in a background thread.
+
+    Args:
+        translate_fn: function from a list of sentences to a list of translations
+        max_batch_size: max sentences per call to translate_fn
+        max_latency_ms: max time a request waits for a batch to fill
+    """
+
+    def __init__(self, translate_fn, max_batch_size=32, max_latency_ms=50):
+        self.translate_fn = translate_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_sentences = 0
+        self.latencies_ms = deque(maxlen=_LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, sentences):
+        """Translate sentences, blocks until done. Returns (translations, latency_ms)"""
+        request = _Request(list(sentences))
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        latency_ms = (time.time() - request.created) * 1000
+        with self._lock:
+            self.num_requests += 1
+            self.latencies_ms.append(latency_ms)
+        return request.results, latency_ms
+
+    def _collect(self, first):
+        """Requests of the next batch, starting with first"""
+        pending = [first]
+        size = len(first.sentences)
+        deadline = first.created + self.max_latency
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # stop after this batch
+                self._queue.put(None)
+                break
+            pending.append(request)
+            size += len(request.sentences)
+        return pending
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            pending = self._collect(first)
+            sentences = [s for request in pending for s in request.sentences]
+            try:
+                results = []
+                # a batch overflows max_batch_size by at most one request
+                for i in range(0, len(sentences), self.max_batch_size):
+                    results.extend(self.translate_fn(sentences[i:i + self.max_batch_size]))
+                    self.num_batches += 1
+            except Exception as e:
+                tf.logging.error("[server] batch of %d failed: %s" % (len(sentences), e))
+                for request in pending:
+                    request.error = e
+                    request.done.set()
+                continue
+            self.num_sentences += len(sentences)
+            offset = 0
+            for request in pending:
+                request.results = results[offset:offset + len(request.sentences)]
+                offset += len(request.sentences)
+                request.done.set()
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self.latencies_ms)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+        return {
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "sentences": self.num_sentences,
+            "mean_batch_size": self.num_sentences / float(self.num_batches) if self.num_batches else 0.0,
+            "latency_ms_p50": percentile(0.5),
+            "latency_ms_p90": percentile(0.9),
+            "latency_ms_p99": percentile(0.99),
+        }
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def _parse_sentences(data):
+    """Sentences of a /translate request body, ValueError unless it is
+    {"sentences": [str, ...]}. Checked before batching, so a bad request
+    cannot fail the batch of other clients.
+    """
+    body = json.loads(data.decode("utf-8"))
+    if not isinstance(body, dict):
+        raise ValueError("body must be a json object")
+    sentences = body.get("sentences")
+    if not isinstance(sentences, list):
+        raise ValueError("sentences must be a list")
+    if not all(isinstance(sentence, six.string_types) for sentence in sentences):
+        raise ValueError("sentences must be strings")
+    return sentences
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """JSON handler, the batcher is set on the server"""
+
+    def _reply(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            stats = self.server.batcher.stats()
+            if self.server.translator is not None:
+                stats["truncated_inputs"] = self.server.translator.num_truncated
+            self._reply(200, stats)
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/translate":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            sentences = _parse_sentences(self.rfile.read(length))
+        except ValueError as e:
+            self._reply(400, {"error": "bad request: %s" % e})
+            return
+        try:
+            segmented, latency_ms = self.server.batcher.submit(sentences)
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+            return
+        tf.logging.info("[server] %d sentences in %.1f ms" % (len(sentences), latency_ms))
+        self._reply(200, {
+            "translations": [translator_utils.postprocess(hyp) for hyp in segmented],
+            "segmented": segmented,
+            "latency_ms": latency_ms,
+        })
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TranslateServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server with a thread per connection, sharing one DynamicBatcher.
+    Truncated inputs of translator, if given, are reported in /stats.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, batcher, translator=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.batcher = batcher
+        self.translator = translator
+
+
+def translate_remote(sentences, url="http://localhost:8500"):
+    """Client: translate sentences with a running server, returns the json reply"""
+    data = json.dumps({"sentences": list(sentences)}).encode("utf-8")
+    req = urllib_request.Request(url + "/translate", data=data,
+                                 headers={"Content-Type": "application/json"})
+    return json.loads(urllib_request.urlopen(req).read().decode("utf-8"))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_dir', default='data/wmt')
+parser.add_argument('--output_dir', default='train/wmt', help='training dir with checkpoints')
+parser.add_argument('--problem', default='translate_enzh_wmt')
+parser.add_argument('--model', default='transformer')
+parser.add_argument('--hparams_set', default='transformer_base_single_gpu')
+parser.add_argument('--hparams', default='')
+parser.add_argument('--beam_size', type=int, default=4)
+parser.add_argument('--alpha', type=float, default=0.6)
+parser.add_argument('--t2t_usr_dir', default='./data_generators')
+parser.add_argument('--host', default='localhost')
+parser.add_argument('--port', type=int, default=8500)
+parser.add_argument('--max_batch_size', type=int, default=32)
+parser.add_argument('--max_latency_ms', type=float, default=50)
+parser.add_argument('--cache_path', default=None,
+    help='sqlite decode cache, shared with decode_file')
+parser.add_argument('--cache_max_entries', type=int, default=decode_cache.MAX_ENTRIES)
+parser.add_argument('--client', action='store_true',
+    help='translate lines of stdin with a running server')
+
+def main():
+    opt = parser.parse_args()
+    url = "http://%s:%d" % (opt.host, opt.port)
+    if opt.client:
+        sentences = [line.strip() for line in sys.stdin if line.strip()]
+        reply = translate_remote(sentences, url)
+        for translation in reply["translations"]:
+            print(translation)
+        print("latency: %.1f ms" % reply["latency_ms"], file=sys.stderr)
+        return
+
+    tf.logging.set_verbosity(tf.logging.INFO)
+    model = translator_utils.Translator(opt.data_dir, opt.output_dir, opt.problem,
+        opt.model, opt.hparams_set, opt.hparams, opt.beam_size, opt.alpha,
+        t2t_usr_dir=opt.t2t_usr_dir)
+    translate_fn = model.translate
+    cache = None
+    if opt.cache_path:
+        cache = decode_cache.DecodeCache(opt.cache_path, decode_cache.translator_key(model),
+                                         opt.cache_max_entries)
+        translate_fn = decode_cache.cached_translate(translate_fn, cache)
+    batcher = DynamicBatcher(translate_fn, opt.max_batch_size, opt.max_latency_ms)
+    server = TranslateServer((opt.host, opt.port), batcher, model)
+    tf.logging.info("[server] serving %s on %s" % (model.checkpoint_path, url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        model.close()
+        if cache is not None:
+            cache.log_stats()
+            cache.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Warm translation model for the TranslateEnzhWmt problems.
+
+t2t-decoder rebuilds the graph and restores the checkpoint for every run.
+Translator builds the inference graph once, with a placeholder for a batch
+of encoded inputs, restores the checkpoint into a long-lived session, and
+keeps the problem's feature encoders loaded, so batches of sentences can be
+translated one after another without a cold start.
+"""
+import tensorflow as tf
+import re
+import copy
+import time
+
+import numpy as np
+
+from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.utils import decoding
+from tensor2tensor.utils import model_builder
+from tensor2tensor.utils import trainer_utils
+from tensor2tensor.utils import usr_dir
+
+EOS = text_encoder.EOS_ID
+
+def normalize_source(line):
+    """Source sentence as fed to the model: xml tags removed,
+    whitespace collapsed, same as tools/preprocess.py for English.
+    """
+    line = re.sub(r'<.+?>', '', line.strip())
+    return " ".join(line.split())
+
+def postprocess(hyp):
+    """Remove spaces between jieba segments, as in main/decode_wmt.sh"""
+    return re.sub(r"\s+", "", hyp)
+
+def _trim_eos(ids):
+    ids = list(np.asarray(ids).flatten())
+    if EOS in ids:
+        ids = ids[:ids.index(EOS)]
+    return ids
+
+def token_batches(lengths, max_tokens=4096, max_batch_size=128):
+    """Group sentences into batches of similar length.
+
+    Sentences are sorted by length, longest first so an out of memory error
+    shows up in the first batch, and cut into batches whose padded size,
+    batch size * longest length, stays within max_tokens.
+
+    Returns:
+        list of batches, as lists of sentence indices
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches, batch = [], []
+    for i in order:
+        # longest sentence of a batch is its first
+        width = lengths[batch[0]] if batch else lengths[i]
+        if batch and (len(batch) >= max_batch_size or (len(batch) + 1) * width > max_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def build_decode_graph(hparams, model, beam_size=4, alpha=0.6, extra_length=50):
+    """Build the inference graph of model in the default graph.
+    hparams must have problem hparams, see trainer_utils.add_problem_hparams.
+
+    Returns:
+        (inputs, outputs): int32 placeholder of encoded inputs, [batch, length]
+        padded with 0, and the decoded ids tensor.
+    """
+    p_hparams = hparams.problems[0]
+    decode_hp = decoding.decode_hparams("beam_size=%d,alpha=%f,extra_length=%d" %
+                                        (beam_size, alpha, extra_length))
+    inputs = tf.placeholder(tf.int32, shape=[None, None], name="inputs")
+    features = {
+        "inputs": tf.expand_dims(inputs, axis=2),
+        "problem_choice": tf.constant(0),
+        "input_space_id": tf.constant(p_hparams.input_space_id),
+        "target_space_id": tf.constant(p_hparams.target_space_id),
+    }
+    spec = model_builder.model_fn(model, features, tf.estimator.ModeKeys.PREDICT,
+        copy.deepcopy(hparams), problem_names=[p.name for p in hparams.problem_instances],
+        decode_hparams=decode_hp)
+    return inputs, spec.predictions["outputs"]
+
+def pad_batch(batch):
+    """Batch of id lists as an int32 array, padded with 0"""
+    length = max(len(ids) for ids in batch)
+    inputs = np.zeros((len(batch), length), dtype=np.int32)
+    for i, ids in enumerate(batch):
+        inputs[i, :len(ids)] = ids
+    return inputs
+
+def trim_outputs(outputs):
+    """Decoded ids tensor value as id lists, cut at eos"""
+    return [_trim_eos(row) for row in outputs]
+
+class Translator(object):
+    """Inference graph and session of a trained model.
+
+    Args:
+        data_dir: data directory, with vocab files
+        output_dir: training directory, with checkpoints
+        problem: registered problem name, e.g. translate_enzh_wmt
+        model: registered model name, e.g. transformer
+        hparams_set: registered hparams set, e.g. transformer_base_single_gpu
+        hparams: comma-separated hparams overrides
+        beam_size: beam size, 1 for greedy decoding
+        alpha: length penalty
+        checkpoint_path: checkpoint to restore, latest in output_dir if None
+        t2t_usr_dir: directory registering the problems
+        cpu_only: hide GPUs from the session
+        max_input_size: max encoded input length, eos included, <= 0 for no limit
+    """
+
+    def __init__(self, data_dir, output_dir, problem="translate_enzh_wmt",
+                 model="transformer", hparams_set="transformer_base_single_gpu",
+                 hparams="", beam_size=4, alpha=0.6, checkpoint_path=None,
+                 t2t_usr_dir="./data_generators", cpu_only=True, max_input_size=256):
+        usr_dir.import_usr_dir(t2t_usr_dir)
+        self.problem_name = problem
+        self.model_name = model
+        self.hparams_set = hparams_set
+        self.hparams_overrides = hparams
+        self.beam_size = beam_size
+        self.alpha = alpha
+        self.max_input_size = max_input_size
+        self.num_truncated = 0
+        self.checkpoint_path = checkpoint_path or tf.train.latest_checkpoint(output_dir)
+        if self.checkpoint_path is None:
+            raise ValueError("No checkpoint found in %s" % output_dir)
+
+        self.hparams = trainer_utils.create_hparams(hparams_set, data_dir, hparams)
+        trainer_utils.add_problem_hparams(self.hparams, problem)
+        vocabulary = self.hparams.problems[0].vocabulary
+        self.source_vocab = vocabulary["inputs"]
+        self.target_vocab = vocabulary["targets"]
+
+        start = time.time()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._inputs, self._outputs = build_decode_graph(self.hparams, model,
+                                                             beam_size, alpha)
+            saver = tf.train.Saver()
+        config = tf.ConfigProto(allow_soft_placement=True)
+        if cpu_only:
+            config.device_count["GPU"] = 0
+        self.session = tf.Session(graph=self.graph, config=config)
+        saver.restore(self.session, self.checkpoint_path)
+        tf.logging.info("[translator] loaded %s in %.1fs" % (self.checkpoint_path, time.time() - start))
+
+    def encode(self, sentence):
+        """Input ids of a normalized source sentence, with eos.
+        Longer inputs than max_input_size are truncated, see num_truncated.
+        """
+        ids = self.source_vocab.encode(sentence)
+        if self.max_input_size > 0 and len(ids) > self.max_input_size - 1:
+            self.num_truncated += 1
+            tf.logging.warning("[translator] input of %d ids truncated to %d: %s" % (
+                len(ids) + 1, self.max_input_size, sentence[:80]))
+            ids = ids[:self.max_input_size - 1]
+        return ids + [EOS]
+
+    def translate_ids(self, batch):
+        """Decode a batch of input id lists, returns output id lists without eos"""
+        outputs = self.session.run(self._outputs, feed_dict={self._inputs: pad_batch(batch)})
+        return trim_outputs(outputs)
+
+    def translate(self, sentences):
+        """Translate a batch of source sentences, returns jieba-segmented hypotheses"""
+        if not sentences:
+            return []
+        batch = [self.encode(normalize_source(s)) for s in sentences]
+        return [self.target_vocab.decode(ids) for ids in self.translate_ids(batch)]
+
+    def close(self):
+        self.session.close()